@@ -0,0 +1,225 @@
+'''
+.. py:module:: char_markov
+    :platform: Unix
+
+Character level Markov chains of any order with NumPy.
+
+This is the same model as in :mod:`toy_markov`, but instead of counting the
+transitions in a Python loop over nested dictionaries, the text is encoded as
+an array of integer codes and all the transitions are counted at once with
+vectorized operations. Sampling draws a successor for many chains at a time
+with a binary search over the cumulative counts, so the engine can be trained
+on hundreds of megabytes of text and generate millions of characters per
+second.
+'''
+import numpy as np
+
+# Maximum number of cells in a dense transition count table. With more
+# (order+1)-character combinations, the counts are stored sparsely.
+DENSE_LIMIT = 2 ** 22
+
+
+class CharMarkov():
+    '''Character level Markov chain of order **order**.
+
+    The characters of the training text are interned to ids ``0..A-1`` (A is
+    the size of the alphabet) and each state, i.e. **order** subsequent
+    characters, is encoded as an integer with the character ids as its digits
+    in base A. A transition from a state to a character is then the integer
+    ``state * A + char``.
+
+    If there are at most :data:`DENSE_LIMIT` possible transitions, they are
+    counted into a dense table with :func:`numpy.bincount`. Otherwise only
+    the observed transitions are stored in a sparse, CSR-like layout built
+    with :func:`numpy.unique`.
+    '''
+    def __init__(self, order=1):
+        '''
+        :param int order: The order of the Markov chain.
+        '''
+        self.order = order
+        self._alphabet = None
+
+    @property
+    def alphabet(self):
+        '''The characters of the training text in code point order.
+        '''
+        return ''.join(map(chr, self._alphabet))
+
+    def fit(self, text):
+        '''Count the transitions of the text.
+
+        :param str text: Training text, longer than **order** characters.
+        :returns: self
+        '''
+        k = self.order
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+        if len(codes) <= k:
+            raise ValueError("Text must be longer than the order ({})."
+                             .format(k))
+        # Intern the code points with a lookup table instead of sorting.
+        self._alphabet = np.flatnonzero(np.bincount(codes))
+        lookup = np.zeros(self._alphabet[-1] + 1, dtype=np.int64)
+        lookup[self._alphabet] = np.arange(len(self._alphabet))
+        ids = lookup[codes]
+        A = len(self._alphabet)
+        if A ** (k + 1) >= 2 ** 63:
+            raise ValueError("Alphabet of {} characters is too large for "
+                             "order {}.".format(A, k))
+
+        n = len(ids) - k
+        keys = np.zeros(n, dtype=np.int64)
+        for j in range(k + 1):
+            keys = keys * A + ids[j:j+n]
+
+        self._base = A
+        self._dense = A ** (k + 1) <= DENSE_LIMIT
+        if self._dense:
+            counts = np.bincount(keys, minlength=A ** (k + 1))
+            self._cum = np.cumsum(counts)
+        else:
+            transitions, counts = np.unique(keys, return_counts=True)
+            self._states, first = np.unique(transitions // A,
+                                            return_index=True)
+            self._indptr = np.append(first, len(transitions))
+            self._chars = transitions % A
+            self._cum = np.cumsum(counts)
+        return self
+
+    def _rows(self, states):
+        '''Return the (lo, hi)-bounds of the states' rows in the cumulative
+        counts. Rows of unseen states are empty.
+        '''
+        if self._dense:
+            lo = states * self._base
+            return lo, lo + self._base
+        rows = np.searchsorted(self._states, states)
+        rows = np.minimum(rows, len(self._states) - 1)
+        seen = self._states[rows] == states
+        lo = np.where(seen, self._indptr[rows], 0)
+        hi = np.where(seen, self._indptr[rows + 1], 0)
+        return lo, hi
+
+    def _char_ids(self, lo, positions):
+        if self._dense:
+            return positions - lo
+        return self._chars[positions]
+
+    def _cum_before(self, positions):
+        return np.where(positions > 0, self._cum[positions - 1], 0)
+
+    def probabilities(self, state):
+        '''Return the successor probabilities of a state.
+
+        :param str state: **order** characters.
+        :returns: dict, mapping from characters to their probabilities.
+        '''
+        code = self._encode(state)
+        if code is None:
+            return {}
+        lo, hi = self._rows(np.array([code]))
+        lo, hi = int(lo[0]), int(hi[0])
+        counts = np.diff(self._cum[lo:hi], prepend=self._cum_before(lo))
+        total = int(counts.sum())
+        chars = self._char_ids(lo, np.arange(lo, hi))
+        return {chr(self._alphabet[c]): count / total
+                for c, count in zip(chars.tolist(), counts.tolist())
+                if count > 0}
+
+    def _encode(self, state):
+        code = 0
+        for c in state:
+            i = np.searchsorted(self._alphabet, ord(c))
+            if i >= len(self._alphabet) or self._alphabet[i] != ord(c):
+                return None
+            code = code * self._base + int(i)
+        return code
+
+    def generate(self, length, n=1, start=None, seed=None):
+        '''Generate **n** texts of **length** characters in lockstep.
+
+        On each step, the next characters of all chains are drawn at once:
+        a uniform random number is scaled to each chain's row of the
+        cumulative counts and the character is found with
+        :func:`numpy.searchsorted`. A chain stops early if it reaches a state
+        which was never followed by a character (e.g. the end of the text).
+
+        :param int length: Length of the texts in characters.
+        :param int n: Number of texts.
+        :param str start:
+            Starting state (**order** characters) for all chains. If
+            **None**, the starting states are drawn in proportion to their
+            frequency in the training text.
+        :param int seed: Seed for the random number generator.
+        :returns: list of **n** generated texts.
+        '''
+        k = self.order
+        A = self._base
+        rng = np.random.default_rng(seed)
+        if start is not None:
+            code = self._encode(start)
+            if code is None or len(start) != k:
+                raise LookupError("Unknown starting state '{}'.".format(start))
+            states = np.full(n, code, dtype=np.int64)
+        else:
+            states = self._random_states(n, rng)
+
+        out = np.zeros((n, max(length, k)), dtype=np.int64)
+        code = states.copy()
+        for j in range(k - 1, -1, -1):
+            out[:, j] = code % A
+            code //= A
+        # Texts shorter than the order are cut from the starting states.
+        lengths = np.full(n, max(length, 0), dtype=np.int64)
+
+        live = np.arange(n)
+        shift = A ** (k - 1)
+        for pos in range(k, length):
+            lo, hi = self._rows(states)
+            base = self._cum_before(lo)
+            totals = self._cum_before(hi) - base
+            dead = totals == 0
+            if dead.any():
+                lengths[live[dead]] = pos
+                keep = ~dead
+                live, states, lo, hi, base, totals = (
+                    live[keep], states[keep], lo[keep], hi[keep], base[keep],
+                    totals[keep])
+            if len(live) == 0:
+                break
+            target = base + rng.random(len(live)) * totals
+            positions = np.minimum(
+                np.searchsorted(self._cum, target, side='right'), hi - 1)
+            chars = self._char_ids(lo, positions)
+            out[live, pos] = chars
+            states = (states % shift) * A + chars
+
+        text = self._alphabet[out]
+        return [''.join(map(chr, row[:m])) for row, m in
+                zip(text.tolist(), lengths.tolist())]
+
+    def _random_states(self, n, rng):
+        '''Draw states in proportion to how often they are followed by a
+        character.
+        '''
+        if self._dense:
+            totals = np.diff(self._cum[self._base-1::self._base],
+                             prepend=0)
+            states = np.arange(len(totals))
+        else:
+            totals = np.diff(self._cum[self._indptr[1:] - 1], prepend=0)
+            states = self._states
+        cum = np.cumsum(totals)
+        rows = np.searchsorted(cum, rng.random(n) * cum[-1], side='right')
+        return states[np.minimum(rows, len(states) - 1)]
+
+
+if __name__ == '__main__':
+    import random
+    # The same toy data as in toy_markov.py.
+    dist = 'Iä! Iä! Cthulhu for president!'
+    data = ''.join([random.choice(dist) for _ in range(10000)])
+    mc = CharMarkov(order=1).fit(data)
+    for c in mc.alphabet:
+        print(repr(c), mc.probabilities(c))
+    print(mc.generate(10)[0])
@@ -5,68 +5,149 @@
 Sample code to parse written text to a more appropriate form. This code is
 designed to be used to create state transitions for Markov chains.
 '''
+import hashlib
 import os
 import re
 import nltk
-
-# Download Alice's Adventures in Wonderland if it is not yet present
-alice_file = 'alice.txt'
-alice_raw = None
-
-if not os.path.isfile(alice_file):
-    from urllib import request
-    url = 'http://www.gutenberg.org/cache/epub/19033/pg19033.txt'
-    response = request.urlopen(url)
-    alice_raw = response.read().decode('utf8')
-    with open(alice_file, 'w', encoding='utf8') as f:
-        f.write(alice_raw)
-else:
-    with open(alice_file, 'r', encoding='utf8') as f:
-        alice_raw = f.read()
-
-# Remove the start and end bloat from Project Gutenberg (this is not exact, but
-# easy).
-pattern = r'\*\*\* START OF THIS PROJECT GUTENBERG EBOOK .+ \*\*\*'
-end = "End of the Project Gutenberg"
-start_match = re.search(pattern, alice_raw)
-if start_match:
-    start_index = start_match.span()[1] + 1
-else:
-    start_index = 0
-end_index = alice_raw.rfind(end)
-alice = alice_raw[start_index:end_index]
-
-# And replace more than one subsequent whitespace chars with one space
-alice = re.sub(r'\s+', ' ', alice)
-
-# Tokenize the text into sentences.
-sentences = nltk.sent_tokenize(alice)
-
-# Tokenize each sentence to words. Each item in 'words' is a list with
-# tokenized words from that list.
-tokenized_sentences = []
-for s in sentences:
-    w = nltk.word_tokenize(s)
-    tokenized_sentences.append(w)
-
-# Next, we sanitize the 'words' somewhat. We remove all tokens that do not have
-# any Unicode word characters, and force each sentence's last token to '.'.
-# You can try other sanitation methods (e.g. look at the last sentence).
-is_word = re.compile('\w')
-sanitized_sentences = []
-for sent in tokenized_sentences:
-    sanitized = [token for token in sent if is_word.search(token)] + ['.']
-    sanitized_sentences.append(sanitized)
-
-# Now we are ready to create the state transitions. However, this time we
-# count the state transitions from each sentence at a time.
-transitions = {}
-# TODO: make this work!
-
-
-
-
-
-
-
-
+import numpy as np
+
+# Bump this when the tokenization changes, so that old cached tokenizations
+# are not used.
+TOKEN_CACHE_VERSION = 1
+
+ALICE_URL = 'http://www.gutenberg.org/cache/epub/19033/pg19033.txt'
+
+
+def load_alice(alice_file='alice.txt', offline=False):
+    '''Read Alice's Adventures in Wonderland and clean it up.
+
+    Nothing is read or downloaded when this module is imported, only when
+    this function is called.
+
+    :param str alice_file:
+        Local file for the book. The book is downloaded into it if the file
+        does not exist.
+    :param bool offline:
+        If **True**, never download the book, but raise
+        :exc:`FileNotFoundError` if the file does not exist.
+    :returns: The text of the book with whitespace collapsed.
+    '''
+    # Download Alice's Adventures in Wonderland if it is not yet present
+    if not os.path.isfile(alice_file):
+        if offline:
+            raise FileNotFoundError("{} not found and downloading is disabled."
+                                    .format(alice_file))
+        from urllib import request
+        response = request.urlopen(ALICE_URL)
+        alice_raw = response.read().decode('utf8')
+        with open(alice_file, 'w', encoding='utf8') as f:
+            f.write(alice_raw)
+    else:
+        with open(alice_file, 'r', encoding='utf8') as f:
+            alice_raw = f.read()
+
+    # Remove the start and end bloat from Project Gutenberg (this is not exact,
+    # but easy).
+    pattern = r'\*\*\* START OF THIS PROJECT GUTENBERG EBOOK .+ \*\*\*'
+    end = "End of the Project Gutenberg"
+    start_match = re.search(pattern, alice_raw)
+    if start_match:
+        start_index = start_match.span()[1] + 1
+    else:
+        start_index = 0
+    end_index = alice_raw.rfind(end)
+    alice = alice_raw[start_index:end_index]
+
+    # And replace more than one subsequent whitespace chars with one space
+    return re.sub(r'\s+', ' ', alice)
+
+
+def tokenize(text):
+    '''Tokenize text into sentences of sanitized tokens.
+    '''
+    # Tokenize the text into sentences.
+    sentences = nltk.sent_tokenize(text)
+
+    # Tokenize each sentence to words. Each item in 'words' is a list with
+    # tokenized words from that list.
+    tokenized_sentences = []
+    for s in sentences:
+        w = nltk.word_tokenize(s)
+        tokenized_sentences.append(w)
+
+    # Next, we sanitize the 'words' somewhat. We remove all tokens that do not
+    # have any Unicode word characters, and force each sentence's last token to
+    # '.'. You can try other sanitation methods (e.g. look at the last
+    # sentence).
+    is_word = re.compile('\w')
+    sanitized_sentences = []
+    for sent in tokenized_sentences:
+        sanitized = [token for token in sent if is_word.search(token)] + ['.']
+        sanitized_sentences.append(sanitized)
+    return sanitized_sentences
+
+
+def cached_tokenize(text, cache_dir='token_cache'):
+    '''Tokenize text with :func:`tokenize`, or load the result of an earlier
+    run from the cache.
+
+    The cache file is named by the SHA-1 hash of the text, NLTK's version
+    and :data:`TOKEN_CACHE_VERSION`, so a changed text (or tokenizer) is
+    tokenized again. The sentences are stored as a NumPy archive with the
+    vocabulary, token ids of the whole text and the offsets of the sentences.
+    '''
+    cache_file = _token_cache_file(text, cache_dir)
+    if os.path.isfile(cache_file):
+        return _load_tokenized(cache_file)
+    sentences = tokenize(text)
+    _save_tokenized(cache_file, sentences)
+    return sentences
+
+
+def _token_cache_file(text, cache_dir):
+    '''Return the cache file for the text and the tokenizer settings.
+    '''
+    settings = (TOKEN_CACHE_VERSION, nltk.__version__, 'english')
+    digest = hashlib.sha1(repr(settings).encode('utf8'))
+    digest.update(text.encode('utf8'))
+    return os.path.join(cache_dir, "{}.npz".format(digest.hexdigest()))
+
+
+def _save_tokenized(cache_file, sentences):
+    '''Save tokenized sentences as a vocabulary, an array of token ids and
+    an array of sentence offsets.
+    '''
+    ids = {}
+    flat = [ids.setdefault(t, len(ids)) for sent in sentences for t in sent]
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sent) for sent in sentences])
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    # Write to a temporary file first, so that an interrupted run does not
+    # leave a broken cache file behind.
+    tmp_file = cache_file + '.tmp'
+    vocabulary = sorted(ids, key=ids.get)
+    with open(tmp_file, 'wb') as f:
+        np.savez_compressed(f, vocabulary=np.array(vocabulary, dtype=str),
+                            ids=np.array(flat, dtype=np.uint32),
+                            offsets=offsets)
+    os.replace(tmp_file, cache_file)
+
+
+def _load_tokenized(cache_file):
+    '''Load tokenized sentences saved with :func:`_save_tokenized`.
+    '''
+    with np.load(cache_file) as data:
+        vocabulary = data['vocabulary'].tolist()
+        tokens = [vocabulary[i] for i in data['ids'].tolist()]
+        offsets = data['offsets'].tolist()
+    return [tokens[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+
+if __name__ == '__main__':
+    alice = load_alice()
+    sanitized_sentences = cached_tokenize(alice)
+
+    # Now we are ready to create the state transitions. However, this time we
+    # count the state transitions from each sentence at a time.
+    transitions = {}
+    # TODO: make this work!
@@ -0,0 +1,152 @@
+'''
+.. py:module:: bnc_catalog
+    :platform: Unix
+
+Catalog of the documents in the British National Corpus.
+
+The catalog stores the path, text type, size, modification time and token
+count of each document in an SQLite database. Only the document headers
+are read to build it, and only for new or changed files when it is updated.
+The documents can then be filtered by their attributes without opening the
+files at all::
+
+    catalog = Catalog('bnc_catalog.sqlite')
+    catalog.update(gather_xmls(ROOT_FOLDER))
+    filepaths = catalog.select(text_type='FICTION')
+'''
+from xml.etree import ElementTree as ET
+import logging
+import os
+import re
+import sqlite3
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.DEBUG)
+
+# The header's extent element reads e.g. " 43229 tokens; 43501 w-units;
+# 2244 s-units ".
+_EXTENT = re.compile(r'(\d[\d,]*)\s+(tokens|w-units|words)')
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY,
+    text_type TEXT,
+    size INTEGER,
+    mtime REAL,
+    tokens INTEGER
+)'''
+
+
+def read_header(filepath):
+    '''Read the text type and the token count of a document.
+
+    The parsing stops at the start tag of the document's text element, which
+    comes right after the header.
+
+    :param str filepath: Path to the XML file.
+    :returns:
+        (text_type, tokens)-tuple. Either may be None if it is not found.
+    '''
+    depth = 0
+    tokens = None
+    for event, elem in ET.iterparse(filepath, events=('start', 'end')):
+        if event == 'end':
+            depth -= 1
+            if elem.tag == 'extent' and tokens is None:
+                tokens = _parse_extent(elem.text or '')
+            continue
+        depth += 1
+        if depth == 2 and elem.tag != 'teiHeader':
+            return elem.attrib.get('type'), tokens
+    return None, tokens
+
+
+def _parse_extent(text):
+    counts = {unit: int(n.replace(',', ''))
+              for n, unit in _EXTENT.findall(text)}
+    for unit in ('tokens', 'w-units', 'words'):
+        if unit in counts:
+            return counts[unit]
+    return None
+
+
+class Catalog():
+    '''Persistent catalog of BNC documents in an SQLite database.
+    '''
+    def __init__(self, filename='bnc_catalog.sqlite'):
+        '''
+        :param str filename: Path to the database, created if needed.
+        '''
+        self.filename = filename
+        self._conn = sqlite3.connect(filename)
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def update(self, filepaths, prune=True):
+        '''Add new documents to the catalog and update the changed ones.
+
+        A document is read again only if its size or modification time has
+        changed since it was cataloged.
+
+        :param list filepaths: Paths to the XML files.
+        :param bool prune:
+            If **True**, remove the documents which are not in **filepaths**.
+        :returns: int, the number of documents which were read.
+        '''
+        known = {path: (size, mtime) for path, size, mtime in
+                 self._conn.execute('SELECT path, size, mtime FROM documents')}
+        rows = []
+        for f in filepaths:
+            stat = os.stat(f)
+            if known.get(f) == (stat.st_size, stat.st_mtime):
+                continue
+            text_type, tokens = read_header(f)
+            rows.append((f, text_type, stat.st_size, stat.st_mtime, tokens))
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)',
+                rows)
+            if prune:
+                removed = set(known).difference(filepaths)
+                self._conn.executemany('DELETE FROM documents WHERE path = ?',
+                                       [(f,) for f in removed])
+        logger.info("Cataloged {} new or changed files".format(len(rows)))
+        return len(rows)
+
+    def select(self, text_type=None, min_tokens=None, max_tokens=None):
+        '''Return the paths of the documents matching all the given criteria.
+
+        :param str text_type: Text type, e.g. 'FICTION'.
+        :param int min_tokens: Minimum number of tokens.
+        :param int max_tokens: Maximum number of tokens.
+        :returns: list of paths in sorted order.
+        '''
+        conditions = []
+        params = []
+        for sql, value in (('text_type = ?', text_type),
+                           ('tokens >= ?', min_tokens),
+                           ('tokens <= ?', max_tokens)):
+            if value is not None:
+                conditions.append(sql)
+                params.append(value)
+        query = 'SELECT path FROM documents'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return [path for path, in
+                self._conn.execute(query + ' ORDER BY path', params)]
+
+    def text_types(self):
+        '''Return the number of documents and tokens of each text type.
+
+        :returns: dict, mapping from text types to (documents, tokens)-tuples.
+        '''
+        return {text_type: (n, tokens) for text_type, n, tokens in
+                self._conn.execute('SELECT text_type, COUNT(*), SUM(tokens) '
+                                   'FROM documents GROUP BY text_type')}
+
+    def __len__(self):
+        query = 'SELECT COUNT(*) FROM documents'
+        return self._conn.execute(query).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
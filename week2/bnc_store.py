@@ -0,0 +1,195 @@
+'''
+.. py:module:: bnc_store
+    :platform: Unix
+
+Compact columnar storage for the tokens parsed from the British National
+Corpus.
+
+Instead of a list of (text, c5)-tuples, the tokens are stored as columns:
+the words and the CLAWS C5 tags are interned and each token is stored as a
+word id and a tag id. Sentences and documents are stored as offsets into the
+token and sentence columns, respectively. A store is a directory with the
+following files:
+
+* ``words.u4``: word id of each token (little endian uint32)
+* ``tags.u1``: tag id of each token (uint8)
+* ``sentences.i8``: offsets of the sentences' first tokens, followed by the
+  number of tokens (little endian int64)
+* ``documents.i8``: offsets of the documents' first sentences, followed by
+  the number of sentences (little endian int64)
+* ``meta.json``: the word vocabulary, the tag set and the document names
+
+The columns are written incrementally, one document at a time, and opened as
+memory maps, so loading a store only reads the vocabulary and the tokens of a
+document are read from disk when the document is accessed.
+
+Example::
+
+    with TokenStoreWriter('parsed_BNC') as writer:
+        for f, sentences in parse_documents(filepaths):
+            writer.add_document(f, sentences)
+
+    store = TokenStore('parsed_BNC')
+    sentences = store.document(0)
+'''
+import json
+import os
+
+import numpy as np
+
+_COLUMNS = {'words': ('words.u4', '<u4'),
+            'tags': ('tags.u1', 'u1'),
+            'sentences': ('sentences.i8', '<i8'),
+            'documents': ('documents.i8', '<i8')}
+_META = 'meta.json'
+
+
+class TokenStoreWriter():
+    '''Write a token store document by document.
+
+    The columns are appended to their files as the documents are added and
+    the vocabulary, the tag set and the document names are written when the
+    writer is closed. An existing store in the directory is overwritten.
+    '''
+    def __init__(self, directory):
+        '''
+        :param str directory: Directory of the store, created if needed.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._files = {name: open(os.path.join(directory, filename), 'wb')
+                       for name, (filename, _) in _COLUMNS.items()}
+        self._words = {}
+        self._tags = {}
+        self._names = []
+        self._n_tokens = 0
+        self._n_sentences = 0
+        self._append('sentences', [0])
+        self._append('documents', [0])
+
+    def _append(self, column, values):
+        dtype = _COLUMNS[column][1]
+        np.asarray(values, dtype=dtype).tofile(self._files[column])
+
+    def add_document(self, name, sentences):
+        '''Add a document to the store.
+
+        :param str name: Name of the document, e.g. its path.
+        :param list sentences: List of lists of (text, c5)-tuples.
+        '''
+        words = []
+        tags = []
+        offsets = []
+        for sentence in sentences:
+            for text, c5 in sentence:
+                words.append(self._words.setdefault(text, len(self._words)))
+                tags.append(self._tags.setdefault(c5, len(self._tags)))
+            offsets.append(self._n_tokens + len(words))
+        if len(self._tags) > 256:
+            raise ValueError("More than 256 distinct tags.")
+        self._append('words', words)
+        self._append('tags', tags)
+        self._append('sentences', offsets)
+        self._n_tokens += len(words)
+        self._n_sentences += len(offsets)
+        self._append('documents', [self._n_sentences])
+        self._names.append(name)
+
+    def close(self):
+        '''Flush the columns and write the metadata.
+        '''
+        for f in self._files.values():
+            f.close()
+        # Sorted by id explicitly, as dicts keep their insertion order only
+        # from Python 3.7 on.
+        meta = {'vocabulary': sorted(self._words, key=self._words.get),
+                'tags': sorted(self._tags, key=self._tags.get),
+                'documents': self._names}
+        with open(os.path.join(self.directory, _META), 'w') as f:
+            json.dump(meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TokenStore():
+    '''Read-only access to a token store written with
+    :class:`TokenStoreWriter`.
+
+    The columns are available as (memory mapped) NumPy arrays in
+    :attr:`words`, :attr:`tags`, :attr:`sentence_offsets` and
+    :attr:`document_offsets`.
+    '''
+    def __init__(self, directory):
+        '''
+        :param str directory: Directory of the store.
+        '''
+        with open(os.path.join(directory, _META)) as f:
+            meta = json.load(f)
+        self.vocabulary = meta['vocabulary']
+        self.tagset = meta['tags']
+        self.names = meta['documents']
+        self._index = {name: i for i, name in enumerate(self.names)}
+        columns = {name: _open_column(os.path.join(directory, filename),
+                                      dtype)
+                   for name, (filename, dtype) in _COLUMNS.items()}
+        self.words = columns['words']
+        self.tags = columns['tags']
+        self.sentence_offsets = columns['sentences']
+        self.document_offsets = columns['documents']
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        '''Return the index of the document with the given name.
+        '''
+        return self._index[name]
+
+    def sentence_range(self, i):
+        '''Return the (start, stop)-range of the document's sentences.
+        '''
+        return (int(self.document_offsets[i]),
+                int(self.document_offsets[i + 1]))
+
+    def token_range(self, i):
+        '''Return the (start, stop)-range of the document's tokens.
+        '''
+        start, stop = self.sentence_range(i)
+        return (int(self.sentence_offsets[start]),
+                int(self.sentence_offsets[stop]))
+
+    def document(self, i):
+        '''Return the sentences of the **i**:th document.
+
+        :returns: list of lists of (text, c5)-tuples.
+        '''
+        start, stop = self.sentence_range(i)
+        offsets = self.sentence_offsets[start:stop + 1].tolist()
+        lo, hi = offsets[0], offsets[-1]
+        vocabulary = self.vocabulary
+        tagset = self.tagset
+        tokens = [(vocabulary[w], tagset[t]) for w, t in
+                  zip(self.words[lo:hi].tolist(), self.tags[lo:hi].tolist())]
+        return [tokens[a - lo:b - lo]
+                for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def tokens(self, i):
+        '''Return the tokens of the **i**:th document.
+
+        :returns: list of (text, c5)-tuples.
+        '''
+        return [token for sentence in self.document(i) for token in sentence]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.names[i], self.document(i)
+
+
+def _open_column(filepath, dtype):
+    if os.path.getsize(filepath) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filepath, dtype=dtype, mode='r')
@@ -0,0 +1,381 @@
+'''
+.. py:module:: edit_distance
+    :platform: Unix
+
+Fast Levenshtein (edit) distances with Myers' bit-parallel algorithm.
+
+Instead of filling the dynamic programming matrix cell by cell, the
+algorithm keeps a whole column of the matrix as bit vectors of the vertical
+differences between adjacent cells (each is -1, 0 or +1) and updates the
+column for each character of the other string with a handful of bitwise
+operations. The bits which are set for each character of the first string,
+the pattern, are computed once and can be reused for any number of other
+strings.
+
+:func:`levenshtein` computes a single distance with Python integers as the
+bit vectors, so the strings can be of any length. :class:`WordBatch`
+computes the distances from one query to a whole list of words at once with
+NumPy, which is what e.g. an agent needs to compare a new artifact to its
+vocabulary or memory. :class:`SimilarityIndex` finds the most similar word
+in a large vocabulary by computing only a few of these distances.
+
+See G. Myers: A fast bit-vector algorithm for approximate string matching
+based on dynamic programming, J. ACM 46(3), 1999, and H. Hyyrö: Explaining
+and extending the bit-parallel approximate string matching algorithm of
+Myers, 2001.
+
+Week 3 imports this module from here.
+'''
+from collections import Counter
+
+import numpy as np
+
+# Below this many words, the per-operation overhead of NumPy outweighs the
+# vectorization and the words are compared one at a time.
+BATCH_MIN_WORDS = 64
+
+
+def _pattern_bits(s):
+    '''Return a dictionary mapping each character of **s** to a bit mask of
+    its positions in **s**.
+    '''
+    peq = {}
+    for i, c in enumerate(s):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    return peq
+
+
+def _myers(peq, m, t):
+    '''Compute the edit distance between a pattern of length **m** (given as
+    its position bit masks **peq**) and **t**.
+    '''
+    mask = (1 << m) - 1
+    top = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    for c in t:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & top:
+            score += 1
+        elif mh & top:
+            score -= 1
+        # The first row of the matrix grows by one on each column, so a
+        # positive horizontal difference is shifted in.
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
+def levenshtein(s, t):
+    '''Compute the edit distance between two strings.
+
+    :param str s: First string.
+    :param str t: Second string.
+    :returns: int, the minimum number of insertions, deletions and
+        substitutions needed to turn **s** into **t**.
+    '''
+    if s == t:
+        return 0
+    if len(s) == 0:
+        return len(t)
+    if len(t) == 0:
+        return len(s)
+    # The pattern is the shorter string, so the bit vectors stay short.
+    if len(s) > len(t):
+        s, t = t, s
+    return _myers(_pattern_bits(s), len(s), t)
+
+
+class WordBatch():
+    '''A list of words which can be compared to a query word all at once.
+
+    The words are stored as a matrix of character ids, padded to the length
+    of the longest word. For a query of at most 64 characters, the query is
+    the pattern and each column of the matrix is processed for all the words
+    at once with NumPy's 64-bit integer operations, so a whole batch costs
+    about as many vectorized operations as the longest word has characters.
+    Longer queries, and batches of less than :data:`BATCH_MIN_WORDS` words,
+    are compared one word at a time with the query's bit masks computed only
+    once.
+    '''
+    def __init__(self, words):
+        '''
+        :param list words: Words (str) to compare the queries to.
+        '''
+        self.words = list(words)
+        self.lengths = np.array([len(w) for w in self.words], dtype=np.int64)
+        self._matrix = None
+
+    def _code_matrix(self):
+        '''Return the character ids of the words sorted by their length
+        (longest first), the sort order and its inverse.
+
+        The matrix is built on first use, as small batches do not need it.
+        '''
+        if self._matrix is None:
+            width = int(self.lengths.max()) if self.words else 0
+            order = np.argsort(-self.lengths, kind='stable')
+            codes = np.zeros((len(self.words), width), dtype=np.uint32)
+            for i, j in enumerate(order.tolist()):
+                w = self.words[j]
+                codes[i, :len(w)] = np.frombuffer(w.encode('utf-32-le'),
+                                                  dtype='<u4')
+            # Intern the characters. The padding is never read, see
+            # distances.
+            alphabet, ids = np.unique(codes, return_inverse=True)
+            ids = ids.reshape(codes.shape).astype(np.int32)
+            self._alphabet = {chr(c): i for i, c in
+                              enumerate(alphabet.tolist())}
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            self._matrix = ids, order, rank
+        return self._matrix
+
+    def __len__(self):
+        return len(self.words)
+
+    def distances(self, query, indices=None):
+        '''Compute the edit distances from **query** to the words.
+
+        :param str query: Query word.
+        :param indices:
+            Indices of the words to compare to, by default all the words.
+        :returns:
+            :class:`numpy.ndarray` of ints, one for each word (in the order
+            of **indices**).
+        '''
+        m = len(query)
+        if indices is None:
+            lengths = self.lengths
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            lengths = self.lengths[indices]
+        n = len(lengths)
+        if m == 0:
+            return lengths.copy()
+        if m > 64 or n < BATCH_MIN_WORDS:
+            if indices is None:
+                words = self.words
+            else:
+                words = [self.words[i] for i in indices.tolist()]
+            peq = _pattern_bits(query)
+            return np.array([_myers(peq, m, w) for w in words],
+                            dtype=np.int64)
+
+        codes, order, rank = self._code_matrix()
+        if indices is None:
+            placement = order
+        else:
+            # Keep the rows sorted by length, longest first.
+            positions = rank[indices]
+            placement = np.argsort(positions, kind='stable')
+            codes = codes[positions[placement]]
+        sorted_lengths = lengths[placement]
+        width = int(sorted_lengths[0])
+        # Column j is processed only for the words longer than j, which are
+        # a prefix of the rows.
+        live = np.searchsorted(-sorted_lengths, -np.arange(width),
+                               side='left')
+        codes = codes[:, :width]
+
+        one = np.uint64(1)
+        mask = np.uint64((1 << m) - 1)
+        top = np.uint64(1 << (m - 1))
+        # The pattern bits of each character id, zero for the characters
+        # which are not in the query.
+        table = np.zeros(len(self._alphabet), dtype=np.uint64)
+        for c, bits in _pattern_bits(query).items():
+            i = self._alphabet.get(c)
+            if i is not None:
+                table[i] = bits
+        eq_all = table[codes]
+
+        pv = np.full(n, mask, dtype=np.uint64)
+        mv = np.zeros(n, dtype=np.uint64)
+        score = np.full(n, m, dtype=np.int64)
+        for j in range(width):
+            k = live[j]
+            eq = eq_all[:k, j]
+            p = pv[:k]
+            v = mv[:k]
+            xv = eq | v
+            xh = (((eq & p) + p) ^ p) | eq
+            ph = v | (~(xh | p) & mask)
+            mh = p & xh
+            score[:k] += (ph & top).astype(bool)
+            score[:k] -= (mh & top).astype(bool)
+            ph = ((ph << one) | one) & mask
+            mh = (mh << one) & mask
+            pv[:k] = mh | (~(xv | ph) & mask)
+            mv[:k] = ph & xv
+        distances = np.empty(n, dtype=np.int64)
+        distances[placement] = score
+        return distances
+
+    def similarities(self, query):
+        '''Compute the normalized similarities from **query** to the words.
+
+        The similarity of strings :math:`s` and :math:`w` is
+        :math:`1 - \\texttt{lev}(s, w) / \\max(|s|, |w|)`.
+
+        :param str query: Query word.
+        :returns: :class:`numpy.ndarray` of floats, one for each word.
+        '''
+        return 1.0 - self.normalized_distances(query)
+
+    def normalized_distances(self, query):
+        '''Compute the edit distances from **query** to the words, divided by
+        the length of the longer string.
+
+        :param str query: Query word.
+        :returns: :class:`numpy.ndarray` of floats, one for each word.
+        '''
+        mlen = np.maximum(self.lengths, len(query)).astype(np.float64)
+        return self.distances(query) / mlen
+
+
+def levenshtein_many(s, words):
+    '''Compute the edit distances from **s** to each of the **words**.
+
+    For repeated queries against the same words, create a
+    :class:`WordBatch` once and call its :meth:`~WordBatch.distances`.
+
+    :param str s: Query string.
+    :param list words: Strings to compare **s** to.
+    :returns: list of ints.
+    '''
+    return WordBatch(words).distances(s).tolist()
+
+
+class SimilarityIndex():
+    '''Index for finding the most similar word in a vocabulary.
+
+    A search has two phases. The filter phase bounds the similarity of every
+    word without computing any edit distances. The verification phase then
+    computes the exact similarities, but only for the words whose bound can
+    beat the best match.
+
+    The bound comes from the bag distance, i.e. the number of characters
+    left over when the characters the two strings have in common are paired
+    off. It is a metric and a lower bound of the edit distance:
+    :math:`\\texttt{lev}(s, w) \\geq \\max(|s|, |w|) - c(s, w)`, where
+    :math:`c(s, w)` is the number of common characters, counted with
+    multiplicity. The index stores how many times each character occurs in
+    each word, so the bounds of all the words are computed at once with
+    NumPy, with one operation per distinct character of the query.
+
+    The words with the highest bounds are compared to the query first, which
+    usually finds the best match early. Of the rest, typically only a percent
+    or less have a high enough bound to be compared at all.
+
+    See I. Bartolini, P. Ciaccia and M. Patella: String matching with metric
+    trees using an approximate distance, SPIRE 2002.
+    '''
+    def __init__(self, words, n_first=256):
+        '''
+        :param list words:
+            Words to index. The position of a word in the list breaks the ties
+            in :meth:`best_match`.
+        :param int n_first:
+            Number of words with the highest bounds to compare to the query
+            before filtering the rest.
+        '''
+        self.words = list(words)
+        self.n_first = n_first
+        self._batch = WordBatch(self.words)
+        self._chars = {}
+        rows = []
+        cols = []
+        for i, w in enumerate(self.words):
+            for c in w:
+                rows.append(self._chars.setdefault(c, len(self._chars)))
+                cols.append(i)
+        # Occurrences of each character (row) in each word (column).
+        self._counts = np.zeros((len(self._chars), len(self.words)),
+                                dtype=np.int16)
+        np.add.at(self._counts, (rows, cols), 1)
+        if len(self.words) >= BATCH_MIN_WORDS:
+            self._batch._code_matrix()
+
+    def __len__(self):
+        return len(self.words)
+
+    def bounds(self, query):
+        '''Compute an upper bound for the similarity of each word to
+        **query**, see :meth:`best_match`.
+
+        :param str query: Query word.
+        :returns: :class:`numpy.ndarray` of floats, one for each word.
+        '''
+        common = np.zeros(len(self.words), dtype=np.int64)
+        for c, n in Counter(query).items():
+            i = self._chars.get(c)
+            if i is not None:
+                common += np.minimum(self._counts[i], n)
+        longest = np.maximum(self._batch.lengths, len(query))
+        return 1.0 - (longest - common) / longest.astype(np.float64)
+
+    def best_match(self, query):
+        '''Find the word with the highest normalized similarity to **query**.
+
+        The similarity of strings :math:`s` and :math:`w` is
+        :math:`1 - \\texttt{lev}(s, w) / \\max(|s|, |w|)`. The result is
+        the same as scanning the words in order and keeping the first word
+        whose similarity is strictly higher than that of the best word so far,
+        starting from similarity 0 and the first word.
+
+        :param str query: Query word.
+        :returns: (similarity, word)-tuple.
+        '''
+        n = len(self.words)
+        if n == 0:
+            raise ValueError("Can not match against an empty vocabulary.")
+        longest = np.maximum(self._batch.lengths, len(query))
+        longest = longest.astype(np.float64)
+        best, best_index = 0.0, 0
+        if n < BATCH_MIN_WORDS:
+            similarities = 1.0 - self._batch.distances(query) / longest
+            best, best_index = _best(similarities, np.arange(n), best,
+                                     best_index)
+            return best, self.words[best_index]
+
+        bounds = self.bounds(query)
+        first = np.argpartition(-bounds, min(self.n_first, n) - 1)
+        first = first[:self.n_first]
+        similarities = (1.0 - self._batch.distances(query, first) /
+                        longest[first])
+        best, best_index = _best(similarities, first, best, best_index)
+
+        # Only a word with a higher bound, or an equal bound and a smaller
+        # index, can still beat the best match.
+        candidates = (bounds > best) | ((bounds == best) &
+                                        (np.arange(n) < best_index))
+        candidates[first] = False
+        rest = np.flatnonzero(candidates)
+        if len(rest) > 0:
+            similarities = (1.0 - self._batch.distances(query, rest) /
+                            longest[rest])
+            best, best_index = _best(similarities, rest, best, best_index)
+        return best, self.words[best_index]
+
+
+def _best(similarities, indices, best, best_index):
+    '''Update the (best, best_index)-pair with the highest similarity,
+    breaking the ties by the smallest index.
+    '''
+    if len(similarities) == 0:
+        return best, best_index
+    top = float(similarities.max())
+    if top < best:
+        return best, best_index
+    index = int(indices[similarities == top].min())
+    if top > best:
+        return top, index
+    return best, min(best_index, index)
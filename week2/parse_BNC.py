@@ -7,15 +7,33 @@ POS-tags.
 
 `Download it <http://ota.ox.ac.uk/desc/2554>`_
 
-The code is not optimized in anyway, when using the whole corpus, the Python
-program ends up using ~3.5GB of memory in the end! For example, it could be
-profitable to train your model (Markov chain, etc.) straight when parsing each
-document.
+The documents are read with :func:`iter_tokens`, which parses them
+incrementally and frees each sentence once its tokens have been yielded, so
+the memory used by the parser stays flat regardless of the document size.
+The parsed documents are written one at a time into a compact columnar
+:class:`~bnc_store.TokenStore`, instead of collecting all the tokens of the
+whole corpus into a single list, which would use ~3.5GB of memory in the end!
+A model can also be trained straight when parsing each document with
+:func:`train`, e.g. the Markov chain of week 3::
+
+    from markov_models import MarkovModel
+    from markov_agent import MarkovAgent
+
+    model = train(MarkovModel(2), parse_documents(filepaths), states='pair')
+    agent = MarkovAgent(env, model)
 '''
 from xml.etree import ElementTree as ET
+import functools
+import hashlib
 import logging
+import multiprocessing
 import os
-import pickle
+import time
+
+import numpy as np
+
+from bnc_catalog import Catalog, read_header
+from bnc_store import TokenStoreWriter
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -27,6 +45,22 @@ TEXT_TYPE = 'FICTION' # Other text types include e.g. NEWS
 # the sub-folders in Texts instead.
 ROOT_FOLDER = "/Users/pihatonttu/corpora/2554/2554/download/Texts"
 
+# SQLite catalog of the documents' text types, sizes, etc. Only the new or
+# changed files are read to update it.
+CATALOG_FILE = 'bnc_catalog.sqlite'
+
+# Directory for the parsed documents. A document is parsed again only if its
+# path, size or modification time, or the parser version, has changed.
+CACHE_DIR = 'parse_cache'
+
+# Increment when the parsing changes, so that the cached documents are
+# parsed again.
+PARSER_VERSION = 1
+
+# Tokens of the Markov chain states in train: 'word', 'tag' (C5) or 'pair'
+# ('word/C5').
+STATES = ('word', 'tag', 'pair')
+
 
 def parse_etree(etree):
     '''Parse element tree for tags 'w' and 'c' in their appearance order.
@@ -43,37 +77,257 @@ def parse_etree(etree):
     return parsed
 
 
+def read_text_type(filepath):
+    '''Read the text type of a document without parsing its text, see
+    :func:`bnc_catalog.read_header`.
+
+    :param str filepath: Path to the XML file.
+    :returns: str, the text type, e.g. 'FICTION', or None if it is missing.
+    '''
+    return read_header(filepath)[0]
+
+
+def iter_sentences(filepath):
+    '''Stream the sentences of a document in their appearance order.
+
+    The document is parsed incrementally with :func:`ET.iterparse` and each
+    element is detached from its parent as soon as it ends, so only the
+    currently open elements and the current sentence are kept in memory.
+
+    :param str filepath: Path to the XML file.
+    :returns:
+        generator of lists of (text, c5)-tuples, where c5 is the CLAWS C5
+        POS-tag.
+    '''
+    path = []
+    sentence = []
+    for event, elem in ET.iterparse(filepath, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem)
+            continue
+        path.pop()
+        if path:
+            path[-1].remove(elem)
+        if elem.tag == 'w' or elem.tag == 'c':
+            sentence.append((elem.text, elem.attrib['c5']))
+        elif elem.tag == 's':
+            if sentence:
+                yield sentence
+            sentence = []
+    if sentence:
+        yield sentence
+
+
+def iter_tokens(filepath):
+    '''Stream the tags 'w' and 'c' of a document in their appearance order.
+
+    Yields the same tokens as :func:`parse_etree` on the parsed document,
+    but without building the whole element tree, see :func:`iter_sentences`.
+
+    :param str filepath: Path to the XML file.
+    :returns:
+        generator of (text, c5)-tuples, where c5 is the CLAWS C5 POS-tag.
+    '''
+    for sentence in iter_sentences(filepath):
+        yield from sentence
+
+
 def gather_xmls(root_folder):
-    '''Get a list of .xml files in the root's subfolders.
+    '''Get a sorted list of .xml files in the root's subfolders.
     '''
-    ret = os.walk(root_folder)
     filepaths = []
-    for r in ret:
-        fps = [os.path.join(r[0], e) for e in r[2] if e.endswith('.xml')]
-        filepaths = filepaths + fps
+    for dirpath, _, filenames in os.walk(root_folder):
+        filepaths.extend(os.path.join(dirpath, e) for e in filenames
+                         if e.endswith('.xml'))
+    filepaths.sort()
     logger.info("Gathered {} files".format(len(filepaths)))
     return filepaths
 
 
-if __name__ == '__main__':
-    filepaths = gather_xmls(ROOT_FOLDER)
-    texts = []
-
-    for f in filepaths:
-        logger.info("Reading: {}".format(f))
-        etree = ET.parse(f)
-        root = etree.getroot()
-        text_type = root[1].attrib['type']
-        if root[1].attrib['type'] != TEXT_TYPE:
-            logger.info("Skipping {} (type={})".format(f, text_type))
-        else:
-            parsed = parse_etree(etree)
-            texts = texts + parsed
-            logger.info("Parsed {} tokens from {}. (Total {})"
-                        .format(len(parsed), f, len(texts)))
-
-    # Save the list as a pickle. Load it using pickle.load.
-    with open('parsed_BNC.pkl', 'ab') as f:
-        pickle.dump(texts, f)
+def parse_document(filepath, text_type=TEXT_TYPE, cache_dir=None):
+    '''Parse the sentences of a document if it has the given text type.
+
+    :param str filepath: Path to the XML file.
+    :param str text_type:
+        Text type to parse, or None to parse all documents.
+    :param str cache_dir:
+        If given, the parsed document is saved to this directory and loaded
+        from it on later calls, as long as the file has not changed.
+    :returns:
+        (text_type, sentences)-tuple, where sentences is a list of lists of
+        (text, c5)-tuples, or None if the document was skipped.
+    '''
+    if cache_dir is not None:
+        cache_file = _parse_cache_file(filepath, cache_dir)
+        if os.path.isfile(cache_file):
+            doc_type, sentences = _load_parsed(cache_file)
+            if text_type is not None and doc_type != text_type:
+                return doc_type, None
+            return doc_type, sentences
+
+    doc_type = read_text_type(filepath)
+    if text_type is not None and doc_type != text_type:
+        return doc_type, None
+    sentences = list(iter_sentences(filepath))
+    if cache_dir is not None:
+        _save_parsed(cache_file, doc_type, sentences)
+    return doc_type, sentences
+
 
+def _parse_cache_file(filepath, cache_dir):
+    '''Return the cache file for the document in its current state.
+    '''
+    stat = os.stat(filepath)
+    key = (PARSER_VERSION, os.path.abspath(filepath), stat.st_size,
+           stat.st_mtime)
+    digest = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+    return os.path.join(cache_dir, "{}.npz".format(digest))
+
+
+def _save_parsed(cache_file, doc_type, sentences):
+    '''Save a parsed document as word and tag vocabularies, arrays of word
+    and tag ids and an array of sentence offsets.
+    '''
+    words = {}
+    tags = {}
+    word_ids = [words.setdefault(text, len(words))
+                for sentence in sentences for text, _ in sentence]
+    tag_ids = [tags.setdefault(c5, len(tags))
+               for sentence in sentences for _, c5 in sentence]
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sentence) for sentence in sentences])
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    # Write to a temporary file first, so that an interrupted run does not
+    # leave a broken cache file behind.
+    tmp_file = cache_file + '.tmp'
+    vocabulary = sorted(words, key=words.get)
+    tagset = sorted(tags, key=tags.get)
+    with open(tmp_file, 'wb') as f:
+        np.savez_compressed(f, text_type=np.array(doc_type or '', dtype=str),
+                            words=np.array(vocabulary, dtype=str),
+                            tags=np.array(tagset, dtype=str),
+                            word_ids=np.array(word_ids, dtype=np.uint32),
+                            tag_ids=np.array(tag_ids, dtype=np.uint32),
+                            offsets=offsets)
+    os.replace(tmp_file, cache_file)
+
+
+def _load_parsed(cache_file):
+    '''Load a parsed document saved with :func:`_save_parsed`.
+
+    :returns: (text_type, sentences)-tuple.
+    '''
+    with np.load(cache_file) as data:
+        doc_type = str(data['text_type']) or None
+        words = data['words'].tolist()
+        tags = data['tags'].tolist()
+        tokens = [(words[w], tags[t]) for w, t in
+                  zip(data['word_ids'].tolist(), data['tag_ids'].tolist())]
+        offsets = data['offsets'].tolist()
+    return doc_type, [tokens[offsets[i]:offsets[i+1]]
+                      for i in range(len(offsets) - 1)]
+
+
+def parse_documents(filepaths, text_type=TEXT_TYPE, processes=None,
+                    cache_dir=None):
+    '''Parse the documents in worker processes.
+
+    The documents are handed out to the workers one at a time and the results
+    are yielded in the order of **filepaths**, regardless of which worker
+    finishes first. Only the results that have not been consumed yet are held
+    in memory. The progress is logged after each document.
+
+    :param list filepaths: Paths to the XML files.
+    :param str text_type: Text type to parse, or None to parse all documents.
+    :param int processes:
+        Number of worker processes, defaults to the number of CPUs. With 1,
+        the documents are parsed in this process.
+    :param str cache_dir: Cache directory, see :func:`parse_document`.
+    :returns:
+        generator of (filepath, sentences)-tuples for the documents with the
+        text type, see :func:`parse_document`.
+    '''
+    parse = functools.partial(parse_document, text_type=text_type,
+                              cache_dir=cache_dir)
+    if processes == 1:
+        yield from _log_progress(filepaths, map(parse, filepaths))
+        return
+    with multiprocessing.Pool(processes) as pool:
+        yield from _log_progress(filepaths, pool.imap(parse, filepaths))
+
+
+def _log_progress(filepaths, results):
+    n = len(filepaths)
+    n_tokens = 0
+    t0 = time.perf_counter()
+    for i, (f, (doc_type, sentences)) in enumerate(zip(filepaths, results)):
+        if sentences is None:
+            logger.info("[{}/{}] Skipping {} (type={})"
+                        .format(i + 1, n, f, doc_type))
+            continue
+        tokens = sum(len(s) for s in sentences)
+        n_tokens += tokens
+        # Cached documents can come back before the clock has advanced.
+        elapsed = max(time.perf_counter() - t0, 1e-9)
+        logger.info("[{}/{}] Parsed {} tokens from {}. (Total {}, {:.0f} "
+                    "tokens/s)".format(i + 1, n, tokens, f, n_tokens,
+                                       n_tokens / elapsed))
+        yield f, sentences
+
+
+def sentence_tokens(sentence, states='word'):
+    '''Convert a parsed sentence to the tokens of a Markov chain's states.
+
+    :param list sentence: List of (text, c5)-tuples.
+    :param str states:
+        'word' for the words, 'tag' for the C5 tags or 'pair' for both as
+        'word/C5' strings, e.g. 'cat/NN1'.
+    :returns: list of str.
+    '''
+    if states == 'word':
+        return [text.strip() for text, _ in sentence]
+    if states == 'tag':
+        return [c5 for _, c5 in sentence]
+    if states == 'pair':
+        return ["{}/{}".format(text.strip(), c5) for text, c5 in sentence]
+    raise ValueError("Unknown states '{}', expected one of {}."
+                     .format(states, STATES))
+
+
+def train(model, documents, states='word'):
+    '''Update a model with the documents as they are parsed.
+
+    Each document is counted into the model as soon as it arrives and is
+    dropped afterwards, so the tokens of the whole corpus are never held in
+    memory at once.
+
+    :param model:
+        Model with an ``update(tokenized_sentences)`` method, e.g.
+        :class:`~markov_models.MarkovModel` or
+        :class:`~markov_models.NGramTrie` from week 3.
+    :param documents:
+        Iterable of (filepath, sentences)-tuples, e.g. from
+        :func:`parse_documents`.
+    :param str states: Tokens of the states, see :func:`sentence_tokens`.
+    :returns: the updated model.
+    '''
+    if states not in STATES:
+        raise ValueError("Unknown states '{}', expected one of {}."
+                         .format(states, STATES))
+    for _, sentences in documents:
+        model.update(sentence_tokens(sentence, states)
+                     for sentence in sentences)
+    return model
+
+
+if __name__ == '__main__':
+    catalog = Catalog(CATALOG_FILE)
+    catalog.update(gather_xmls(ROOT_FOLDER))
+    filepaths = catalog.select(text_type=TEXT_TYPE)
+    logger.info("{} files of type {}".format(len(filepaths), TEXT_TYPE))
 
+    # Load the store using bnc_store.TokenStore('parsed_BNC').
+    with TokenStoreWriter('parsed_BNC') as writer:
+        for f, sentences in parse_documents(filepaths, text_type=None,
+                                            cache_dir=CACHE_DIR):
+            writer.add_document(f, sentences)
@@ -14,6 +14,8 @@ import aiomas
 
 from creamas.core import CreativeAgent, Environment, Simulation, Artifact
 
+from edit_distance import SimilarityIndex
+
 # Logging setup. This is simplified setup as all agents use the same logger.
 # It _will_ cause some problems in asynchronous settings, especially if you
 # are logging to a file.
@@ -22,29 +24,6 @@ logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.DEBUG)
 
 
-def levenshtein(s, t):
-        '''Compute the edit distance between two strings.
-
-        From Wikipedia article; Iterative with two matrix rows.
-        '''
-        if s == t: return 0
-        elif len(s) == 0: return len(t)
-        elif len(t) == 0: return len(s)
-        v0 = [None] * (len(t) + 1)
-        v1 = [None] * (len(t) + 1)
-        for i in range(len(v0)):
-            v0[i] = i
-        for i in range(len(s)):
-            v1[0] = i + 1
-            for j in range(len(t)):
-                cost = 0 if s[i] == t[j] else 1
-                v1[j + 1] = min(v1[j] + 1, v0[j + 1] + 1, v0[j] + cost)
-            for j in range(len(v0)):
-                v0[j] = v1[j]
-
-        return v1[len(t)]
-
-
 def parse_words(filename, encoding, word_pattern, wlen_limits):
     '''Parse acceptable words from the file.
 
@@ -128,6 +107,9 @@ class ToyAgent(CreativeAgent):
         self.vocab = frequent_words(filename, encoding=encoding,
                                     word_pattern=self.word_pattern,
                                     wlen_limits=self.wlen_limits, n=20)
+        # The vocabulary is compared to every evaluated word, so it is
+        # indexed for finding the best match fast.
+        self._vocab_index = SimilarityIndex(self.vocab)
 
     def evaluate(self, artifact):
         '''Evaluate given artifact with respect to the words the agent knows.
@@ -146,14 +128,7 @@ class ToyAgent(CreativeAgent):
             (evaluation, word)-tuple, containing both the evaluation and the
             word giving the maximum evaluation
         '''
-        evaluation = 0.0
-        evaluation_word = artifact.obj
-        for word in self.vocab:
-            lev = levenshtein(evaluation_word, word)
-            mlen = max(len(evaluation_word), float(len(word)))
-            current_evaluation = 1.0 - (float(lev) / mlen)
-            if current_evaluation > evaluation:
-                evaluation = current_evaluation
+        evaluation, _ = self._vocab_index.best_match(artifact.obj)
         return evaluation
 
     def generate(self):
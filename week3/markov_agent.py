@@ -9,42 +9,125 @@ import random
 
 from creamas import CreativeAgent, Environment, Simulation, Artifact
 
+import bisect
+import functools
+import hashlib
+import heapq
+import itertools
+import math
+import multiprocessing
 import os
 import operator
 import re
-import nltk
+import numpy as np
+
+from markov_models import (CountMinSketch, HeavyHitters, StartStates,
+                           ngram_transitions)
 
 ORDER = 2
 
-# Download Alice's Adventures in Wonderland if it is not yet present
-alice_file = 'alice.txt'
-alice_raw = None
-
-if not os.path.isfile(alice_file):
-    from urllib import request
-    url = 'http://www.gutenberg.org/cache/epub/19033/pg19033.txt'
-    response = request.urlopen(url)
-    alice_raw = response.read().decode('utf8')
-    with open(alice_file, 'w', encoding='utf8') as f:
-        f.write(alice_raw)
-else:
-    with open(alice_file, 'r', encoding='utf8') as f:
-        alice_raw = f.read()
-
-# Remove the start and end bloat from Project Gutenberg (this is not exact, but
-# easy).
-pattern = r'\*\*\* START OF THIS PROJECT GUTENBERG EBOOK .+ \*\*\*'
-end = "End of the Project Gutenberg"
-start_match = re.search(pattern, alice_raw)
-if start_match:
-    start_index = start_match.span()[1] + 1
-else:
-    start_index = 0
-end_index = alice_raw.rfind(end)
-alice = alice_raw[start_index:end_index]
-
-# And replace more than one subsequent whitespace chars with one space
-alice = re.sub(r'\s+', ' ', alice)
+# Bump this when the tokenization changes, so that old cached tokenizations
+# are not used.
+TOKEN_CACHE_VERSION = 1
+
+ALICE_URL = 'http://www.gutenberg.org/cache/epub/19033/pg19033.txt'
+
+
+class GutenbergText():
+    '''Project Gutenberg text, which is read and cleaned up only when it is
+    first used.
+
+    If the file does not exist, the text is downloaded from **url** and
+    saved to the file, unless the text is **offline**, in which case a
+    :exc:`FileNotFoundError` is raised instead.
+    '''
+    def __init__(self, filename, url, offline=False):
+        '''
+        :param str filename: Local file for the text.
+        :param str url: URL to download the text from.
+        :param bool offline: Only use the local file, never download.
+        '''
+        self.filename = filename
+        self.url = url
+        self.offline = offline
+        self._raw = None
+        self._text = None
+
+    @property
+    def raw(self):
+        '''The text as it is in the file.
+        '''
+        if self._raw is None:
+            if os.path.isfile(self.filename):
+                with open(self.filename, 'r', encoding='utf8') as f:
+                    self._raw = f.read()
+            elif self.offline:
+                raise FileNotFoundError("{} not found and downloading is "
+                                        "disabled (offline)."
+                                        .format(self.filename))
+            else:
+                from urllib import request
+                response = request.urlopen(self.url)
+                self._raw = response.read().decode('utf8')
+                with open(self.filename, 'w', encoding='utf8') as f:
+                    f.write(self._raw)
+        return self._raw
+
+    @property
+    def text(self):
+        '''The text without the Project Gutenberg start and end bloat, and
+        with whitespace collapsed to single spaces.
+        '''
+        if self._text is None:
+            self._text = clean_gutenberg(self.raw)
+        return self._text
+
+
+def clean_gutenberg(raw_text):
+    '''Remove the start and end bloat of a Project Gutenberg text, and
+    replace subsequent whitespace characters with one space.
+    '''
+    # Remove the start and end bloat from Project Gutenberg (this is not
+    # exact, but easy).
+    pattern = r'\*\*\* START OF THIS PROJECT GUTENBERG EBOOK .+ \*\*\*'
+    end = "End of the Project Gutenberg"
+    start_match = re.search(pattern, raw_text)
+    if start_match:
+        start_index = start_match.span()[1] + 1
+    else:
+        start_index = 0
+    end_index = raw_text.rfind(end)
+    text = raw_text[start_index:end_index]
+
+    # And replace more than one subsequent whitespace chars with one space
+    return re.sub(r'\s+', ' ', text)
+
+
+# Alice's Adventures in Wonderland, downloaded if it is not yet present.
+alice_text = GutenbergText('alice.txt', ALICE_URL)
+
+
+def load_alice(alice_file='alice.txt', offline=False):
+    '''Read Alice's Adventures in Wonderland and clean it up.
+
+    Nothing is read or downloaded when this module is imported, only when
+    this function is called. The book in the default file is read only once
+    and its raw text is in ``alice_text.raw``.
+
+    :param str alice_file:
+        Local file for the book. The book is downloaded into it if the file
+        does not exist.
+    :param bool offline:
+        If **True**, never download the book, but raise
+        :exc:`FileNotFoundError` if the file does not exist.
+    :returns: The text of the book with whitespace collapsed.
+    '''
+    if alice_file == alice_text.filename:
+        text = alice_text
+    else:
+        text = GutenbergText(alice_file, ALICE_URL)
+    text.offline = offline
+    return text.text
 
 def _sanitize(tokenized_sentences):
     is_word = re.compile('\w')
@@ -55,13 +138,67 @@ def _sanitize(tokenized_sentences):
     return sanitized_sentences
 
 
-def tokenize(raw_text, sanitize=True):
+def tokenize(raw_text, sanitize=True, cache_dir=None, processes=1):
     '''Tokenize raw text to sentences and then each sentences to individual
     tokens (words).
+
+    :param str raw_text: Text to tokenize.
+    :param bool sanitize: Sanitize the tokenized sentences.
+    :param str cache_dir:
+        Directory for cached tokenizations. If given, the tokenized sentences
+        are stored there keyed by the hash of the text and the tokenizer
+        settings, and later calls with the same text and settings load them
+        instead of tokenizing again.
+    :param int processes:
+        Number of worker processes tokenizing the sentences, see
+        :func:`iter_tokenize`.
     '''
+    if cache_dir is not None:
+        cache_file = _token_cache_file(raw_text, sanitize, cache_dir)
+        if os.path.isfile(cache_file):
+            return _load_tokenized(cache_file)
+
+    tokenized_sentences = list(iter_tokenize(raw_text, sanitize=sanitize,
+                                             processes=processes))
+    if cache_dir is not None:
+        _save_tokenized(cache_file, tokenized_sentences)
+    return tokenized_sentences
+
+def iter_tokenize(raw_text, sanitize=True, processes=1, chunksize=500):
+    '''Tokenize raw text lazily, yielding one tokenized sentence at a time.
+
+    The text is first split into sentences, which are then tokenized to
+    words (and sanitized) in chunks of **chunksize** sentences. With more
+    than one process, the chunks are tokenized in a process pool. The
+    sentences are yielded in their original order as soon as their chunk is
+    done, so e.g. :meth:`~markov_models.MarkovModel.update` can start
+    counting before the whole text is tokenized.
+
+    :param str raw_text: Text to tokenize.
+    :param bool sanitize: Sanitize the tokenized sentences.
+    :param int processes: Number of worker processes.
+    :param int chunksize: Number of sentences in one chunk.
+    '''
+    # NLTK is slow to import, so it is imported only when it is needed.
+    import nltk
     # Tokenize the text into sentences.
     sentences = nltk.sent_tokenize(raw_text)
-
+    chunks = [sentences[i:i+chunksize]
+              for i in range(0, len(sentences), chunksize)]
+    work = functools.partial(_tokenize_sentences, sanitize=sanitize)
+
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            for tokenized_sentences in pool.imap(work, chunks):
+                yield from tokenized_sentences
+    else:
+        for chunk in chunks:
+            yield from work(chunk)
+
+def _tokenize_sentences(sentences, sanitize):
+    '''Tokenize sentences to words and sanitize them.
+    '''
+    import nltk
     # Tokenize each sentence to words. Each item in 'words' is a list with
     # tokenized words from that list.
     tokenized_sentences = []
@@ -73,9 +210,56 @@ def tokenize(raw_text, sanitize=True):
         tokenized_sentences = _sanitize(tokenized_sentences)
     return tokenized_sentences
 
-def get_transitions(tokenized_sentences):
+def _token_cache_file(raw_text, sanitize, cache_dir):
+    '''Return the cache file for the text and the tokenizer settings.
+    '''
+    import nltk
+    settings = (TOKEN_CACHE_VERSION, nltk.__version__, 'english', sanitize)
+    digest = hashlib.sha1(repr(settings).encode('utf8'))
+    digest.update(raw_text.encode('utf8'))
+    return os.path.join(cache_dir, "{}.npz".format(digest.hexdigest()))
+
+def _save_tokenized(cache_file, tokenized_sentences):
+    '''Save tokenized sentences as a vocabulary, an array of token ids and
+    an array of sentence offsets.
+    '''
+    ids = {}
+    flat = [ids.setdefault(t, len(ids)) for sent in tokenized_sentences
+            for t in sent]
+    offsets = np.zeros(len(tokenized_sentences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sent) for sent in tokenized_sentences])
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    # Write to a temporary file first, so that an interrupted run does not
+    # leave a broken cache file behind.
+    tmp_file = cache_file + '.tmp'
+    vocabulary = sorted(ids, key=ids.get)
+    with open(tmp_file, 'wb') as f:
+        np.savez_compressed(f, vocabulary=np.array(vocabulary, dtype=str),
+                            ids=np.array(flat, dtype=np.uint32),
+                            offsets=offsets)
+    os.replace(tmp_file, cache_file)
+
+def _load_tokenized(cache_file):
+    '''Load tokenized sentences saved with :func:`_save_tokenized`.
+    '''
+    with np.load(cache_file) as data:
+        vocabulary = data['vocabulary'].tolist()
+        tokens = [vocabulary[i] for i in data['ids'].tolist()]
+        offsets = data['offsets'].tolist()
+    return [tokens[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+def get_transitions(tokenized_sentences, processes=1):
     '''Compute the state transition counts from the tokenized sentences.
+
+    :param list tokenized_sentences: Sentences, each a list of tokens.
+    :param int processes:
+        Number of worker processes. If more than one, the sentences are split
+        into shards which are counted in parallel and merged in order. The
+        result is identical to counting with a single process.
     '''
+    if processes > 1:
+        return _get_transitions_parallel(tokenized_sentences, processes)
+
     transitions = {}
     # TODO: make this work!
     for sentence in tokenized_sentences:
@@ -96,6 +280,105 @@ def get_transitions(tokenized_sentences):
                 transitions[pred][succ] += 1.0
     return transitions
 
+def _get_transitions_parallel(tokenized_sentences, processes):
+    '''Count the state transitions of sentence shards in a process pool.
+    '''
+    tokenized_sentences = list(tokenized_sentences)
+    # Use a few shards per process so that uneven shards do not leave workers
+    # idle at the end.
+    n_shards = processes * 4
+    size = max(1, -(-len(tokenized_sentences) // n_shards))
+    shards = [tokenized_sentences[i:i+size]
+              for i in range(0, len(tokenized_sentences), size)]
+    transitions = {}
+    with multiprocessing.Pool(processes) as pool:
+        # imap returns the shards in order, so the merged dictionaries have
+        # the same key order as the serially counted ones.
+        for shard_transitions in pool.imap(get_transitions, shards):
+            _merge_transitions(transitions, shard_transitions)
+    return transitions
+
+def _merge_transitions(transitions, other):
+    '''Add the state transition counts in **other** to **transitions**.
+    '''
+    for pred, succ_counts in other.items():
+        counts = transitions.get(pred)
+        if counts is None:
+            transitions[pred] = succ_counts
+            continue
+        for succ, count in succ_counts.items():
+            counts[succ] = counts.get(succ, 0.0) + count
+
+def get_frequent_transitions(tokenized_sentences, min_count=2, memory=2**26,
+                             delta=0.01, top_k=None):
+    '''Count only the frequent state transitions, in bounded memory.
+
+    The transitions, i.e. the (ORDER+1)-grams of the sentences, are first
+    counted approximately into a :class:`~markov_models.CountMinSketch` of
+    **memory** bytes. Its estimates are never too small, so a second pass
+    which counts exactly only the transitions estimated to occur at least
+    **min_count** times keeps all the frequent transitions and their exact
+    counts. For this, **tokenized_sentences** is iterated twice, so it can
+    not be a generator.
+
+    If **top_k** is given, the sentences are iterated only once and the
+    **top_k** most frequent transitions are tracked with
+    :class:`~markov_models.HeavyHitters` instead. Their counts are then the
+    sketch's estimates, which may exceed the true counts by at most the
+    sketch's :attr:`~markov_models.CountMinSketch.error_bound` with
+    probability 1 - **delta**.
+
+    :param tokenized_sentences: Sentences, each a list of tokens.
+    :param int min_count: Minimum count of a transition to keep.
+    :param int memory: Memory budget of the sketch in bytes.
+    :param float delta: Failure probability of the sketch.
+    :param int top_k: Number of transitions to keep in a single pass.
+    :returns:
+        Nested dictionaries of state transition counts, in the same format as
+        :func:`get_transitions`.
+    '''
+    if top_k is not None:
+        heavy = HeavyHitters(top_k, memory=memory, delta=delta)
+        heavy.update(_ngrams(tokenized_sentences))
+        return ngram_transitions((ngram, count) for ngram, count in
+                                 heavy.most_common() if count >= min_count)
+
+    sketch = CountMinSketch(memory=memory, delta=delta)
+    sketch.update(_ngrams(tokenized_sentences))
+    counts = {}
+    chunk = []
+    for ngram in itertools.chain(_ngrams(tokenized_sentences), [None]):
+        if ngram is not None:
+            chunk.append(ngram)
+            if len(chunk) < 65536:
+                continue
+        for key, estimate in zip(chunk, sketch.estimates(chunk)):
+            if estimate >= min_count:
+                counts[key] = counts.get(key, 0) + 1
+        chunk = []
+    return ngram_transitions((ngram, count) for ngram, count in
+                             counts.items() if count >= min_count)
+
+def _ngrams(tokenized_sentences):
+    for sentence in tokenized_sentences:
+        for i in range(len(sentence)-ORDER):
+            yield tuple(sentence[i:i+ORDER+1])
+
+def get_starts(tokenized_sentences):
+    '''Count the sentence-initial states of the tokenized sentences.
+
+    Only sentences which have at least one state transition are counted, so
+    that generation starting from these states does not stop right away.
+
+    :returns: dict, mapping from states to their counts.
+    '''
+    starts = {}
+    for sentence in tokenized_sentences:
+        if len(sentence) > ORDER:
+            state = tuple(sentence[:ORDER])
+            starts[state] = starts.get(state, 0) + 1
+    return starts
+
 def get_probabilities(transitions):
     '''Compute state transition probabilities from the state transition counts.
     '''
@@ -113,16 +396,117 @@ def get_probabilities(transitions):
             probs[pred][succ] = count / totals[pred]
     return probs
 
-def markov_chain(raw_text):
-    tokenized_sentences = tokenize(raw_text)
-    transitions = get_transitions(tokenized_sentences)
+def markov_chain(raw_text, processes=1, cache_dir=None):
+    tokenized_sentences = tokenize(raw_text, cache_dir=cache_dir,
+                                   processes=processes)
+    transitions = get_transitions(tokenized_sentences, processes=processes)
     probs = get_probabilities(transitions)
     return probs
 
+def _unseen_probabilities(n):
+    '''Small random probabilities (in [0, 0.001]) for **n** unobserved state
+    transitions.
+    '''
+    return [random.random() * 0.001 for _ in range(n)]
+
+class TransitionSampler():
+    '''Sampler compiled once from MC state transition probabilities.
+
+    For each preceding state the successors and their cumulative
+    probabilities are stored in two parallel lists. Drawing a successor is
+    then a binary search over the cumulative probabilities, i.e.
+    O(log k) for a state with k successors, instead of re-accumulating the
+    probabilities on every step.
+
+    The sampler draws from the same distribution as a linear walk over
+    ``stp[prec].items()``. The cumulative probabilities are scaled with their
+    sum, so that rounding errors in the probabilities do not cause a draw to
+    fall off the end of the list.
+    '''
+    def __init__(self, stp, starts=None):
+        '''
+        :param dict stp:
+            MC state transition probabilities as nested dictionaries, see
+            :class:`MarkovAgent`.
+        :param dict starts:
+            Optional counts of sentence-initial states, see
+            :func:`get_starts`.
+        '''
+        self._stp = stp
+        self._states = list(stp.keys())
+        # Like TransitionMatrix, leave out the start states which have no
+        # successors, so that a pruned model does not begin dead ends.
+        if starts:
+            starts = {state: count for state, count in starts.items()
+                      if stp.get(state)}
+        self._starts = StartStates(starts) if starts else None
+        self._order = len(self._states[0])
+        self._cdfs = {}
+        for prec, probs in stp.items():
+            if len(probs) == 0:
+                continue
+            succs = list(probs.keys())
+            cdf = list(itertools.accumulate(probs.values()))
+            self._cdfs[prec] = (succs, cdf)
+
+    @property
+    def order(self):
+        '''The order of the Markov chain, i.e. the length of its states.
+        '''
+        return self._order
+
+    def __contains__(self, state):
+        return state in self._stp
+
+    def random_state(self):
+        '''Return a random starting state.
+
+        If the sentence-initial states are known, they are drawn in
+        proportion to how often they begin a sentence. Otherwise the state is
+        chosen uniformly from the state transition probabilities.
+        '''
+        if self._starts is not None:
+            return self._starts.sample()
+        return random.choice(self._states)
+
+    def successors(self, state):
+        '''Return the successors of the state as a list of
+        (successor, probability)-tuples. The list is empty if the state has
+        no successors.
+        '''
+        return list(self._stp.get(state, {}).items())
+
+    def probability(self, prec, succ):
+        '''Return the probability of the state transition from **prec** to
+        **succ**, or **None** if the transition has not been observed.
+        '''
+        probs = self._stp.get(prec)
+        if probs is None:
+            return None
+        return probs.get(succ)
+
+    def sample(self, state):
+        '''Draw a successor for the given state.
+
+        :param state: A state of the MC (tuple of strings)
+        :returns:
+            The successor state, or **None** if **state** has no successors.
+        '''
+        compiled = self._cdfs.get(state)
+        if compiled is None:
+            return None
+        succs, cdf = compiled
+        rnd = random.random() * cdf[-1]
+        i = bisect.bisect_right(cdf, rnd)
+        # Guard against rnd rounding up to the total probability.
+        return succs[min(i, len(succs) - 1)]
+
+
 class MarkovAgent(CreativeAgent):
     '''An agent that generates text with a Markov chain.
     '''
-    def __init__(self, env, stp, n=20):
+    def __init__(self, env, stp, n=20, starts=None, search='sample',
+                 top_k=5):
         '''
         :param env: class:`~creamas.core.environment.Environment`
         :param stp:
@@ -135,15 +519,44 @@ class MarkovAgent(CreativeAgent):
 
             The states should be tuples of strings and all tuples should have
             the same length (all states are of same order).
+
+            Instead of the nested dictionaries, **stp** can also be a compiled
+            model which provides the same methods as
+            :class:`TransitionSampler`, e.g.
+            :class:`~markov_models.TransitionMatrix`.
         :param int n:
             Search width, i.e. how many alternatives are considered per call to
             :meth:`invent`.
+        :param dict starts:
+            Counts of sentence-initial states (see :func:`get_starts`) for
+            drawing the starting states of generated texts. Only used with
+            nested dictionaries, compiled models record the sentence-initial
+            states themselves when they are trained.
+        :param str search:
+            How :meth:`invent` searches for artifacts: ``'sample'`` generates
+            **n** independent chains, ``'beam'`` runs a beam search of width
+            **n** (see :meth:`beam_search`) and ``'stochastic_beam'`` a
+            stochastic beam search.
+        :param int top_k:
+            The number of most probable successors each beam is expanded with
+            in beam search.
         '''
+        if search not in ('sample', 'beam', 'stochastic_beam'):
+            raise ValueError("Unknown search '{}'.".format(search))
         super().__init__(env)
         self._stp = stp
+        # Compile the sampler once, so that generation does not have to walk
+        # through the successors on every step. Compiled models know how to
+        # sample themselves.
+        if hasattr(stp, 'sample'):
+            self._sampler = stp
+        else:
+            self._sampler = TransitionSampler(stp, starts=starts)
         # This is the order of the Markov chain in _stp
-        self._order = len(list(self._stp.keys())[0])
+        self._order = self._sampler.order
         self._n = n
+        self._search = search
+        self._top_k = top_k
         name = self.name
         self.name = "{}({})".format(self.__class__.__name__, name)
 
@@ -156,32 +569,26 @@ class MarkovAgent(CreativeAgent):
         :param int length: Length of the text in tokens.
         :param start:
             Starting state for the generation. **None** if starting state
-            should be random.
+            should be random, in which case it is drawn from the
+            sentence-initial states, if they are known.
         :type start: A valid state for the MC (tuple of strings)
         :returns: Generated text.
         '''
-        if start is not None and start not in self._stp:
+        if start is not None and start not in self._sampler:
             raise LookupError("Given starting state '{}' not in transition "
                              "probabilities (_stp).".format(start))
         if start is None:
-            start = random.choice(list(self._stp.keys()))
+            start = self._sampler.random_state()
 
-        gen = ' '.join(start)
-        k = len(start)
+        tokens = list(start)
         prec = start
-        for _ in range(length-k):
-            if prec not in self._stp:
-                return gen
-            probs = self._stp[prec]
-            base = 0.0
-            rng = random.random()
-            for succ, value in probs.items():
-                base += value
-                if rng < base:
-                    gen += " {}".format(succ[-1])
-                    prec = succ
-                    break
-        return gen
+        for _ in range(length-len(start)):
+            succ = self._sampler.sample(prec)
+            if succ is None:
+                break
+            tokens.append(succ[-1])
+            prec = succ
+        return ' '.join(tokens)
 
     def evaluate(self, artifact):
         '''Evaluate the artifact (piece of text) by computing the likelihood 
@@ -189,7 +596,9 @@ class MarkovAgent(CreativeAgent):
 
         The first state is assumed to be given. If the artifact contains states
         (or state transitions) not in the state transition probabilities, we
-        will give them a small random value (in [0, 0.001]).
+        will give them a small random value (in [0, 0.001]). Smoothed models,
+        e.g. :class:`~markov_models.NGramTrie`, give a probability to every
+        state transition and the random value is not needed.
 
         :param artifact:
             `~creamas.core.artifact.Artifact`, for which holds
@@ -224,32 +633,165 @@ class MarkovAgent(CreativeAgent):
             prob = random.random() * 0.001
             prec = states[i]
             succ = states[i+1]
-            if prec in self._stp and succ in self._stp[prec]:
-                prob = self._stp[prec][succ]
+            p = self._sampler.probability(prec, succ)
+            if p is not None:
+                prob = p
             lh *= prob
         return lh
 
+    def evaluate_batch(self, artifacts):
+        '''Compute the log-likelihoods of many artifacts at once.
+
+        Unlike :meth:`evaluate`, the likelihoods are computed in log space,
+        so they do not underflow for long texts. Models which provide
+        ``log_likelihoods``, e.g. :class:`~markov_models.TransitionMatrix`,
+        score all the artifacts with one vectorized lookup. Unobserved state
+        transitions get a small random probability as in :meth:`evaluate`.
+
+        :param list artifacts:
+            `~creamas.core.artifact.Artifact` objects, for which holds
+            ``type(artifact.obj)==str``.
+        :returns: list of log-likelihoods, one per artifact.
+        '''
+        texts = [artifact.obj.split() for artifact in artifacts]
+        if hasattr(self._sampler, 'log_likelihoods'):
+            llhs = self._sampler.log_likelihoods(
+                texts, unseen=_unseen_probabilities)
+            return [float(llh) for llh in llhs]
+        return [self._log_likelihood(self._parse_states(' '.join(tokens)))
+                for tokens in texts]
+
+    def _log_likelihood(self, states):
+        '''Secret log-likelihood evaluation, see :meth:`_likelihood`.
+        '''
+        llh = 0.0
+        if states is None:
+            return llh
+        for i in range(len(states[:-1])):
+            prob = self._sampler.probability(states[i], states[i+1])
+            if prob is None:
+                prob = random.random() * 0.001
+            if prob == 0.0:
+                return -math.inf
+            llh += math.log(prob)
+        return llh
+
+    def learn(self, artifact):
+        '''Learn the state transitions of the artifact's text.
+
+        Only models that can be updated in place, e.g.
+        :class:`~markov_models.MarkovModel`, learn anything. With other
+        models this does nothing.
+
+        :param artifact:
+            `~creamas.core.artifact.Artifact`, for which holds
+            ``type(artifact.obj)==str``.
+        '''
+        # Plain dictionaries also have an update method, so check that the
+        # model is a compiled one which samples itself.
+        if self._sampler is self._stp and hasattr(self._stp, 'update'):
+            self._stp.update([artifact.obj.split()])
+
+    def beam_search(self, width, top_k=5, length=10, stochastic=False):
+        '''Search for a likely text with beam search.
+
+        The search starts from **width** starting states (drawn as in
+        :meth:`generate`) and on each step expands every beam with the
+        **top_k** most probable successors of its last state. Of all the
+        expansions, the **width** ones with the highest log-likelihood are
+        kept. Beams which reach a state with no successors are finished and
+        kept as they are, as in :meth:`generate`.
+
+        In stochastic beam search the expansions are ranked by their
+        log-likelihood perturbed with Gumbel noise, which keeps the beams
+        more diverse.
+
+        :param int width: Number of beams.
+        :param int top_k: Number of successors each beam is expanded with.
+        :param int length: Length of the text in tokens.
+        :param bool stochastic: Use stochastic beam search.
+        :returns:
+            (text, log-likelihood)-tuple of the most likely finished beam.
+        '''
+        # Draw distinct starting states, giving up on duplicates eventually
+        # if the model has only a few starting states.
+        starts = set()
+        for _ in range(width * 10):
+            starts.add(self._sampler.random_state())
+            if len(starts) == width:
+                break
+        # Beams are (log-likelihood, tokens, state, finished)-tuples. A start
+        # state which cannot be expanded is not a text of the full length, so
+        # it loses to every real beam.
+        beams = [(0.0, list(state), state, False)
+                 if self._sampler.successors(state) else
+                 (-math.inf, list(state), state, True) for state in starts]
+        for _ in range(length - self._order):
+            candidates = []
+            for llh, tokens, state, finished in beams:
+                succs = [] if finished else self._sampler.successors(state)
+                if len(succs) == 0:
+                    candidates.append((llh, tokens, state, True))
+                    continue
+                for succ, prob in heapq.nlargest(top_k, succs,
+                                                 key=operator.itemgetter(1)):
+                    if prob > 0.0:
+                        candidates.append((llh + math.log(prob),
+                                           tokens + [succ[-1]], succ, False))
+            if len(candidates) == 0:
+                break
+            if stochastic:
+                # Gumbel-perturbed ranking (the Gumbel-top-k trick).
+                keys = [c[0] - math.log(-math.log(random.random() or 1e-300))
+                        for c in candidates]
+                order = sorted(range(len(candidates)), key=keys.__getitem__,
+                               reverse=True)
+                beams = [candidates[i] for i in order[:width]]
+            else:
+                beams = heapq.nlargest(width, candidates,
+                                       key=operator.itemgetter(0))
+            if all(finished for _, _, _, finished in beams):
+                break
+        llh, tokens, _, _ = max(beams, key=operator.itemgetter(0))
+        return ' '.join(tokens), llh
+
     def invent(self, n):
         '''Invent a new artifact by generating **n** artifacts and selecting
         the best one.
 
-        Selection is done based on :meth:`evaluate`.
+        Selection is done based on :meth:`evaluate_batch`. If the agent was
+        created with a beam search, the artifact is the best result of
+        :meth:`beam_search` of width **n** instead.
 
         :param int n: The number of alternative artifacts generated
         :returns:
             :class:`~creamas.core.artifact.Artifact`, the best artifact based
             on :meth:`evaluate`
         '''
-        g = self.generate()
-        best_artifact = Artifact(self, g)
-        best_eval, _ = self.evaluate(best_artifact)
-        for _ in range(n-1):
-            g = self.generate()
-            artifact = Artifact(self, g)
-            evl, _ = self.evaluate(artifact)
-            if evl > best_eval:
-                best_artifact = artifact
-                best_eval = evl
+        # As in the original implementation, at least one artifact is
+        # generated.
+        n = max(n, 1)
+        if self._search != 'sample':
+            text, llh = self.beam_search(
+                n, top_k=self._top_k,
+                stochastic=self._search == 'stochastic_beam')
+            artifact = Artifact(self, text)
+            best_eval = math.exp(llh)
+            artifact.add_eval(self, best_eval)
+            return artifact, best_eval
+
+        if hasattr(self._sampler, 'generate_batch'):
+            # Advance all the chains in lockstep.
+            texts = self._sampler.generate_batch(n)
+        else:
+            texts = [self.generate() for _ in range(n)]
+        artifacts = [Artifact(self, text) for text in texts]
+        # Compare the candidates by their log-likelihoods, which do not
+        # underflow, but report the likelihood as in :meth:`evaluate`.
+        llhs = self.evaluate_batch(artifacts)
+        best = max(range(len(artifacts)), key=llhs.__getitem__)
+        best_artifact = artifacts[best]
+        best_eval = math.exp(llhs[best])
         best_artifact.add_eval(self, best_eval)
         return best_artifact, best_eval
 
@@ -264,9 +806,11 @@ class MarkovAgent(CreativeAgent):
 
 
 if __name__ == "__main__":
-    probs = markov_chain(alice)
+    tokenized_sentences = tokenize(load_alice(), cache_dir='token_cache')
+    probs = get_probabilities(get_transitions(tokenized_sentences))
+    starts = get_starts(tokenized_sentences)
     env = Environment.create(('localhost', 5555))
-    ma = MarkovAgent(env, probs, n=20)
+    ma = MarkovAgent(env, probs, n=20, starts=starts)
     t = ma.generate(length=10)
     print("generated: {}".format(t))
     import asyncio
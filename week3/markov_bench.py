@@ -0,0 +1,197 @@
+'''
+.. py:module:: markov_bench
+    :platform: Unix
+
+Benchmarks for the Markov chain pipeline in :mod:`markov_agent`.
+
+Each stage of the pipeline (corpus cleanup, tokenization, counting the
+transitions, computing the probabilities, and the agent's generation,
+evaluation and invention) is timed on synthetic corpora of increasing size.
+For every stage and corpus size the benchmark reports the best time over a
+number of repeats, the throughput and the peak memory allocated by the stage
+(measured in a separate run with :mod:`tracemalloc`, as tracing slows the
+code down). The scaling exponent of each stage is the slope of its time
+against the corpus size on a log-log scale, i.e. 1.0 is linear.
+
+The results are written as JSON, so runs on different commits can be
+compared. All randomness is seeded, so the corpora and the generated
+artifacts are the same on every run.
+
+Run e.g.::
+
+    python markov_bench.py --sizes 10000 100000 --output bench.json
+'''
+import argparse
+import bisect
+import itertools
+import json
+import math
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+from creamas import Environment, Artifact
+
+import markov_agent
+
+
+def synthetic_corpus(n_words, seed=0, vocabulary_size=5000):
+    '''Create a synthetic Project Gutenberg style text.
+
+    Words are drawn from a Zipf-like distribution over a fixed vocabulary and
+    sentences have 5-25 words. The text is wrapped in Gutenberg's start and
+    end markers, so that the cleanup has something to remove.
+
+    :param int n_words: Number of words in the text.
+    :param int seed: Random seed.
+    :param int vocabulary_size: Number of distinct words.
+    :returns: str, the text.
+    '''
+    rng = random.Random(seed)
+    vocabulary = ["w{}".format(i) for i in range(vocabulary_size)]
+    cum_weights = list(itertools.accumulate(1.0 / (i + 1)
+                                            for i in range(vocabulary_size)))
+    # A binary search over the cumulative weights, as random.choices needs
+    # Python 3.6.
+    last = vocabulary_size - 1
+    words = [vocabulary[min(bisect.bisect(cum_weights,
+                                          rng.random() * cum_weights[-1]),
+                            last)]
+             for _ in range(n_words)]
+    sentences = []
+    i = 0
+    while i < n_words:
+        k = rng.randint(5, 25)
+        sentence = words[i:i+k]
+        sentences.append(' '.join(sentence).capitalize() + '.')
+        i += k
+    # Break the text into lines as in the Gutenberg texts.
+    body = '\n'.join(' '.join(sentences[i:i+3])
+                     for i in range(0, len(sentences), 3))
+    return ("Header\n*** START OF THIS PROJECT GUTENBERG EBOOK SYNTHETIC ***"
+            "\n{}\nEnd of the Project Gutenberg EBook\n".format(body))
+
+
+def measure(func, repeat, seed):
+    '''Time **func** and measure its peak memory allocation.
+
+    :returns:
+        (seconds, peak_bytes, result)-tuple, where seconds is the best of
+        **repeat** runs.
+    '''
+    best = math.inf
+    for _ in range(repeat):
+        random.seed(seed)
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    random.seed(seed)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def run_pipeline(n_words, env, repeat=3, seed=0, n_artifacts=1000):
+    '''Benchmark each stage of the pipeline on a corpus of **n_words** words.
+
+    :returns: list of result dictionaries, one per stage.
+    '''
+    raw = synthetic_corpus(n_words, seed=seed)
+    results = []
+
+    def record(stage, func, items, unit):
+        seconds, peak, result = measure(func, repeat, seed)
+        results.append({'stage': stage, 'words': n_words,
+                        'seconds': seconds, 'items': items, 'unit': unit,
+                        'throughput': items / seconds if seconds > 0 else None,
+                        'peak_bytes': peak})
+        return result
+
+    text = record('cleanup', lambda: markov_agent.clean_gutenberg(raw),
+                  n_words, 'words')
+    sentences = record('tokenize', lambda: markov_agent.tokenize(text),
+                       n_words, 'words')
+    transitions = record('get_transitions',
+                         lambda: markov_agent.get_transitions(sentences),
+                         n_words, 'words')
+    probs = record('get_probabilities',
+                   lambda: markov_agent.get_probabilities(transitions),
+                   len(transitions), 'states')
+
+    agent = markov_agent.MarkovAgent(env, probs)
+    texts = record('generate',
+                   lambda: [agent.generate() for _ in range(n_artifacts)],
+                   n_artifacts, 'artifacts')
+    artifacts = [Artifact(agent, t) for t in texts]
+    record('evaluate', lambda: [agent.evaluate(a) for a in artifacts],
+           n_artifacts, 'artifacts')
+    n_invent = max(1, n_artifacts // 20)
+    record('invent', lambda: [agent.invent(20) for _ in range(n_invent)],
+           n_invent, 'inventions')
+    return results
+
+
+def scaling_exponents(results):
+    '''Fit the slope of log(seconds) against log(words) for each stage.
+    '''
+    exponents = {}
+    for stage in dict.fromkeys(r['stage'] for r in results):
+        rows = [r for r in results if r['stage'] == stage and r['seconds'] > 0]
+        if len(rows) < 2:
+            continue
+        x = np.log([r['words'] for r in rows])
+        y = np.log([r['seconds'] for r in rows])
+        exponents[stage] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+
+def _git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=subprocess.DEVNULL)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 30000, 100000, 300000],
+                        help="corpus sizes in words")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed runs per stage, the best is reported")
+    parser.add_argument('--artifacts', type=int, default=1000,
+                        help="artifacts generated and evaluated per size")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON file (default: stdout)")
+    args = parser.parse_args()
+
+    env = Environment.create(('localhost', 5555))
+    results = []
+    try:
+        for size in args.sizes:
+            results += run_pipeline(size, env, repeat=args.repeat,
+                                    seed=args.seed,
+                                    n_artifacts=args.artifacts)
+    finally:
+        env.destroy()
+
+    report = {
+        'meta': {'commit': _git_commit(), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'seed': args.seed,
+                 'repeat': args.repeat, 'sizes': args.sizes},
+        'results': results,
+        'scaling': scaling_exponents(results),
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,1280 @@
+'''
+.. py:module:: markov_models
+    :platform: Unix
+
+Alternative, more compact representations for Markov chain models. The models
+can be given to :class:`~markov_agent.MarkovAgent` in place of the nested
+state transition probability dictionaries.
+'''
+from collections.abc import Mapping, Sequence
+import bisect
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import random
+import struct
+
+import numpy as np
+
+
+# Binary file format of TransitionMatrix.save. The header contains the magic
+# bytes, format version, order, vocabulary size, number of states, number of
+# transitions, number of start states and the length of the encoded tokens in
+# bytes.
+_MAGIC = b'MCTM'
+_FORMAT_VERSION = 2
+_HEADER_FORMAT = '<4sIIQQQQQ'
+_HEADER_SIZE = 64
+_ALIGNMENT = 8
+# Arrays stored after the vocabulary, in this order.
+_ARRAYS = [('_keys', '<i8'), ('_indptr', '<i8'), ('_indices', '<i4'),
+           ('_counts', '<f8'), ('_cum', '<f8'), ('_totals', '<f8'),
+           ('_probs', '<f8'), ('_start_rows', '<i8'),
+           ('_start_counts', '<f8')]
+
+
+class AliasTable():
+    '''Walker's alias method for drawing from a discrete distribution in
+    constant time.
+
+    Building the table takes linear time. Each draw then picks a uniformly
+    random column and returns either the column or its alias, depending on
+    a second uniform random number.
+    '''
+    def __init__(self, weights):
+        '''
+        :param weights: Non-negative weights of the outcomes 0..n-1.
+        '''
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        prob = weights * n / weights.sum()
+        alias = np.arange(n, dtype=np.int64)
+        small = [i for i in range(n) if prob[i] < 1.0]
+        large = [i for i in range(n) if prob[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            alias[s] = l
+            prob[l] -= 1.0 - prob[s]
+            if prob[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # What is left is (up to rounding errors) exactly one.
+        prob[small + large] = 1.0
+        self._prob = prob
+        self._alias = alias
+        # Python lists are faster to index one item at a time.
+        self._prob_list = prob.tolist()
+        self._alias_list = alias.tolist()
+
+    def __len__(self):
+        return len(self._prob_list)
+
+    def sample(self):
+        '''Draw one outcome using :mod:`random`.
+        '''
+        i = random.randrange(len(self._prob_list))
+        if random.random() < self._prob_list[i]:
+            return i
+        return self._alias_list[i]
+
+    def sample_many(self, n, rng):
+        '''Draw **n** outcomes at once.
+
+        :param rng: :class:`numpy.random.Generator`
+        :returns: NumPy array of outcomes.
+        '''
+        i = rng.integers(len(self._prob), size=n)
+        return np.where(rng.random(n) < self._prob[i], i, self._alias[i])
+
+
+class StartStates():
+    '''Counts of sentence-initial states, which can be updated and sampled
+    from in logarithmic time.
+
+    The counts are kept in a Fenwick tree (binary indexed tree), in which
+    both adding to a count and finding the state at a cumulative count walk
+    O(log n) nodes. A model which learns and generates in turn thus never
+    rebuilds anything.
+    '''
+    def __init__(self, counts=None):
+        '''
+        :param dict counts: Optional initial counts of the states.
+        '''
+        self._counts = dict(counts) if counts is not None else {}
+        self._states = list(self._counts)
+        self._index = {state: i for i, state in enumerate(self._states)}
+        # 1-based tree, built in linear time.
+        tree = [0] + [self._counts[state] for state in self._states]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._total = sum(self._counts.values())
+
+    def __len__(self):
+        return len(self._counts)
+
+    @property
+    def counts(self):
+        '''The counts of the sentence-initial states.
+        '''
+        return self._counts
+
+    def _prefix(self, i):
+        '''Sum of the counts of the first **i** states.
+        '''
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, state, count=1):
+        '''Add **count** observations of a sentence-initial state.
+        '''
+        tree = self._tree
+        self._total += count
+        i = self._index.get(state)
+        if i is None:
+            # A new last node covers its own count and the nodes below it.
+            i = len(self._states) + 1
+            self._index[state] = i - 1
+            self._states.append(state)
+            self._counts[state] = count
+            tree.append(count + self._prefix(i - 1) -
+                        self._prefix(i - (i & -i)))
+            return
+        self._counts[state] += count
+        i += 1
+        while i < len(tree):
+            tree[i] += count
+            i += i & -i
+
+    def sample(self):
+        '''Draw a state in proportion to its count.
+        '''
+        tree = self._tree
+        n = len(self._states)
+        target = random.random() * self._total
+        pos = 0
+        step = 1 << (n.bit_length() - 1) if n > 0 else 0
+        while step:
+            if pos + step <= n and tree[pos + step] <= target:
+                pos += step
+                target -= tree[pos]
+            step >>= 1
+        # Rounding can push the target past the last state.
+        return self._states[min(pos, n - 1)]
+
+
+class TransitionMatrix(Mapping):
+    '''Markov chain model stored as a sparse matrix of transition counts.
+
+    The tokens are interned to integer ids and each state (a tuple of
+    **order** tokens) is encoded as a single integer, where the token ids are
+    the digits in base ``len(vocabulary)``. The transitions are stored in a
+    CSR-style layout: the successors of the state in row ``r`` are the tokens
+    ``indices[indptr[r]:indptr[r+1]]`` and their counts and probabilities
+    are at the same positions in ``counts`` and ``probabilities``. As the
+    successor state is always the preceding state shifted by one token, only
+    the id of the successor's last token is stored.
+
+    The matrix behaves like the nested dictionaries created by
+    :func:`~markov_agent.get_probabilities`, i.e. ``matrix[prec][succ]``
+    gives the probability of the state transition from ``prec`` to ``succ``,
+    but the dictionaries are built on demand. Use :meth:`probability` and
+    :meth:`sample` for fast lookups.
+    '''
+    def __init__(self, vocabulary, order, keys, indptr, indices, counts,
+                 start_rows=(), start_counts=()):
+        '''
+        Use :meth:`from_sentences` or :meth:`from_transitions` to create new
+        matrices.
+
+        :param list vocabulary: Tokens, the index of a token is its id.
+        :param int order: The order of the Markov chain.
+        :param keys: Sorted integer codes of the preceding states.
+        :param indptr: Row boundaries in **indices** and **counts**.
+        :param indices: Token ids of the successors.
+        :param counts: Counts (or weights) of the transitions.
+        :param start_rows: Rows of the sentence-initial states.
+        :param start_counts: Counts of the sentence-initial states.
+        '''
+        self._vocab = vocabulary
+        self._id_cache = None
+        self._start_table = None
+        self._start_rows = np.asarray(start_rows, dtype=np.int64)
+        self._start_counts = np.asarray(start_counts, dtype=np.float64)
+        self._order = order
+        self._base = len(vocabulary)
+        self._keys = np.asarray(keys, dtype=np.int64)
+        self._indptr = np.asarray(indptr, dtype=np.int64)
+        self._indices = np.asarray(indices, dtype=np.int32)
+        self._counts = np.asarray(counts, dtype=np.float64)
+        # Cumulative counts over the whole matrix. A row's cumulative
+        # distribution is its slice minus the cumulative count before it.
+        self._cum = np.cumsum(self._counts)
+        totals = np.add.reduceat(self._counts, self._indptr[:-1]) \
+            if len(self._counts) > 0 else np.zeros(0)
+        self._totals = totals
+        self._probs = self._counts / np.repeat(totals, np.diff(self._indptr))
+
+    @property
+    def _ids(self):
+        '''Mapping from tokens to their ids, built when first needed.
+        '''
+        if self._id_cache is None:
+            self._id_cache = {t: i for i, t in enumerate(self._vocab)}
+        return self._id_cache
+
+    @classmethod
+    def from_sentences(cls, tokenized_sentences, order):
+        '''Count the state transitions from tokenized sentences.
+
+        Produces the same transitions as
+        :func:`~markov_agent.get_transitions`, but the counting is done with
+        NumPy over the interned token ids.
+
+        :param tokenized_sentences:
+            Iterable of sentences, each sentence a list of tokens.
+        :param int order: The order of the Markov chain.
+        :returns: :class:`TransitionMatrix`
+        '''
+        ids = {}
+        encoded = []
+        for sentence in tokenized_sentences:
+            if len(sentence) <= order:
+                continue
+            encoded.append([ids.setdefault(t, len(ids)) for t in sentence])
+        vocabulary = sorted(ids, key=ids.get)
+        base = _check_base(len(vocabulary), order)
+
+        lengths = np.array([len(s) for s in encoded], dtype=np.int64)
+        flat = np.fromiter((i for s in encoded for i in s), dtype=np.int64,
+                           count=int(lengths.sum()))
+        # Position of each token in its sentence. An n-gram starting at a
+        # position is valid if it does not cross the end of the sentence.
+        starts = np.cumsum(lengths) - lengths
+        pos = np.arange(len(flat)) - np.repeat(starts, lengths)
+        valid = np.flatnonzero(pos < np.repeat(lengths, lengths) - order)
+        codes = np.zeros(len(valid), dtype=np.int64)
+        for j in range(order + 1):
+            codes = codes * base + flat[valid + j]
+        grams, counts = np.unique(codes, return_counts=True)
+        matrix = cls._from_grams(vocabulary, order, grams, counts)
+
+        # Record the sentence-initial states for generation.
+        start_codes = np.zeros(len(starts), dtype=np.int64)
+        for j in range(order):
+            start_codes = start_codes * base + flat[starts + j]
+        start_codes, start_counts = np.unique(start_codes, return_counts=True)
+        matrix._set_starts(start_codes, start_counts)
+        return matrix
+
+    @classmethod
+    def from_transitions(cls, transitions, starts=None):
+        '''Create a matrix from nested state transition dictionaries.
+
+        :param dict transitions:
+            State transition counts as returned by
+            :func:`~markov_agent.get_transitions`, or probabilities as
+            returned by :func:`~markov_agent.get_probabilities`.
+        :param dict starts:
+            Optional counts of sentence-initial states as returned by
+            :func:`~markov_agent.get_starts`.
+        :returns: :class:`TransitionMatrix`
+        '''
+        ids = {}
+        for prec, succs in transitions.items():
+            for token in prec:
+                ids.setdefault(token, len(ids))
+            for succ in succs:
+                ids.setdefault(succ[-1], len(ids))
+        vocabulary = sorted(ids, key=ids.get)
+        order = len(next(iter(transitions)))
+        base = _check_base(len(vocabulary), order)
+
+        grams = []
+        counts = []
+        for prec, succs in transitions.items():
+            code = 0
+            for token in prec:
+                code = code * base + ids[token]
+            for succ, count in succs.items():
+                grams.append(code * base + ids[succ[-1]])
+                counts.append(count)
+        grams = np.array(grams, dtype=np.int64)
+        counts = np.array(counts, dtype=np.float64)
+        sort = np.argsort(grams)
+        matrix = cls._from_grams(vocabulary, order, grams[sort], counts[sort])
+        if starts:
+            codes = [matrix._encode(state) for state in starts]
+            known = [(code, count) for code, count in
+                     zip(codes, starts.values()) if code is not None]
+            if known:
+                start_codes, start_counts = zip(*known)
+                matrix._set_starts(np.array(start_codes, dtype=np.int64),
+                                   np.array(start_counts, dtype=np.float64))
+        return matrix
+
+    def _set_starts(self, codes, counts):
+        '''Set the sentence-initial states from their codes and counts.
+        States which have no successors are left out.
+        '''
+        rows = np.minimum(np.searchsorted(self._keys, codes),
+                          max(len(self._keys) - 1, 0))
+        found = self._keys[rows] == codes if len(self._keys) > 0 else \
+            np.zeros(len(codes), dtype=bool)
+        self._start_rows = rows[found]
+        self._start_counts = np.asarray(counts, dtype=np.float64)[found]
+        self._start_table = None
+
+    @property
+    def _starts(self):
+        '''Alias table over the sentence-initial states, or **None** if they
+        are not known. Built when first needed.
+        '''
+        if self._start_table is None and len(self._start_rows) > 0:
+            self._start_table = AliasTable(self._start_counts)
+        return self._start_table
+
+    @classmethod
+    def _from_grams(cls, vocabulary, order, grams, counts):
+        '''Build the CSR layout from sorted (order+1)-gram codes.
+        '''
+        base = len(vocabulary)
+        states = grams // base
+        keys, first = np.unique(states, return_index=True)
+        indptr = np.append(first, len(grams))
+        return cls(vocabulary, order, keys, indptr, grams % base, counts)
+
+    def save(self, filename):
+        '''Save the matrix into a binary file which can be opened with
+        :meth:`load`.
+
+        The file contains a fixed size header followed by the vocabulary
+        (token offsets and UTF-8 encoded tokens) and the arrays of the
+        matrix, including the derived cumulative counts and probabilities,
+        each aligned to 8 bytes. All integers and floats are little-endian.
+
+        :param str filename: Path to the file.
+        '''
+        encoded = [str(token).encode('utf8') for token in self._vocab]
+        offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        tokens = b''.join(encoded)
+        header = struct.pack(_HEADER_FORMAT, _MAGIC, _FORMAT_VERSION,
+                             self._order, len(self._vocab), len(self._keys),
+                             len(self._indices), len(self._start_rows),
+                             len(tokens))
+        with open(filename, 'wb') as f:
+            f.write(header.ljust(_HEADER_SIZE, b'\0'))
+            _write_aligned(f, offsets.tobytes())
+            _write_aligned(f, tokens)
+            for name, dtype in _ARRAYS:
+                data = np.ascontiguousarray(getattr(self, name), dtype=dtype)
+                _write_aligned(f, data.tobytes())
+
+    @classmethod
+    def load(cls, filename):
+        '''Open a matrix saved with :meth:`save`.
+
+        The file is memory-mapped read-only and the arrays of the matrix are
+        views into the mapping, so opening the file is nearly instant and
+        all matrices opened from the same file, in any number of agents and
+        processes, share the same physical memory pages. Tokens are decoded
+        from the mapping when they are needed.
+
+        :param str filename: Path to the file.
+        :returns: :class:`TransitionMatrix`
+        '''
+        with open(filename, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from('<4sI', buf)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise ValueError("{} is not a version {} transition matrix file."
+                             .format(filename, _FORMAT_VERSION))
+        _, _, order, n_vocab, n_states, n_entries, n_starts, n_bytes = \
+            struct.unpack_from(_HEADER_FORMAT, buf)
+        sizes = {'_keys': n_states, '_indptr': n_states + 1,
+                 '_indices': n_entries, '_counts': n_entries,
+                 '_cum': n_entries, '_totals': n_states,
+                 '_probs': n_entries, '_start_rows': n_starts,
+                 '_start_counts': n_starts}
+
+        offset = _HEADER_SIZE
+        offsets = np.frombuffer(buf, dtype='<i8', count=n_vocab + 1,
+                                offset=offset)
+        offset = _aligned(offset + offsets.nbytes)
+        vocabulary = _MappedVocabulary(buf, offset, offsets)
+        offset = _aligned(offset + n_bytes)
+
+        matrix = cls.__new__(cls)
+        matrix._vocab = vocabulary
+        matrix._id_cache = None
+        matrix._start_table = None
+        matrix._order = order
+        matrix._base = n_vocab
+        for name, dtype in _ARRAYS:
+            array = np.frombuffer(buf, dtype=dtype, count=sizes[name],
+                                  offset=offset)
+            setattr(matrix, name, array)
+            offset = _aligned(offset + array.nbytes)
+        return matrix
+
+    @property
+    def order(self):
+        '''The order of the Markov chain, i.e. the length of its states.
+        '''
+        return self._order
+
+    @property
+    def vocabulary(self):
+        '''The tokens of the model, the index of a token is its id.
+        '''
+        return self._vocab
+
+    @property
+    def counts(self):
+        '''Transition counts in CSR order.
+        '''
+        return self._counts
+
+    @property
+    def probabilities(self):
+        '''Transition probabilities in CSR order.
+        '''
+        return self._probs
+
+    def _encode(self, state):
+        '''Return the integer code of the state, or **None** if the state
+        contains unknown tokens.
+        '''
+        if len(state) != self._order:
+            return None
+        code = 0
+        for token in state:
+            i = self._ids.get(token)
+            if i is None:
+                return None
+            code = code * self._base + i
+        return code
+
+    def _decode(self, code):
+        '''Return the state (tuple of tokens) for the integer code.
+        '''
+        code = int(code)
+        tokens = []
+        for _ in range(self._order):
+            code, i = divmod(code, self._base)
+            tokens.append(self._vocab[i])
+        return tuple(reversed(tokens))
+
+    def _row(self, state):
+        '''Return the row of the state, or -1 if it has no successors.
+        '''
+        code = self._encode(state)
+        if code is None:
+            return -1
+        row = int(np.searchsorted(self._keys, code))
+        if row < len(self._keys) and self._keys[row] == code:
+            return row
+        return -1
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        for code in self._keys:
+            yield self._decode(code)
+
+    def __contains__(self, state):
+        return self._row(state) >= 0
+
+    def __getitem__(self, state):
+        row = self._row(state)
+        if row < 0:
+            raise KeyError(state)
+        lo, hi = self._indptr[row], self._indptr[row+1]
+        prefix = tuple(state[1:])
+        return {prefix + (self._vocab[i],): float(p) for i, p in
+                zip(self._indices[lo:hi], self._probs[lo:hi])}
+
+    def random_state(self):
+        '''Return a random starting state.
+
+        If the sentence-initial states are known, they are drawn in
+        proportion to how often they begin a sentence, in constant time.
+        Otherwise the state is chosen uniformly among the states which have
+        successors.
+        '''
+        if self._starts is not None:
+            row = self._start_rows[self._starts.sample()]
+        else:
+            row = random.randrange(len(self._keys))
+        return self._decode(self._keys[row])
+
+    def successors(self, state):
+        '''Return the successors of the state as a list of
+        (successor, probability)-tuples. The list is empty if the state has
+        no successors.
+        '''
+        row = self._row(state)
+        if row < 0:
+            return []
+        lo, hi = self._indptr[row], self._indptr[row+1]
+        prefix = tuple(state[1:])
+        return [(prefix + (self._vocab[i],), p) for i, p in
+                zip(self._indices[lo:hi].tolist(),
+                    self._probs[lo:hi].tolist())]
+
+    def probability(self, prec, succ):
+        '''Return the probability of the state transition from **prec** to
+        **succ**, or **None** if the transition has not been observed.
+        '''
+        row = self._row(prec)
+        if row < 0 or tuple(succ[:-1]) != tuple(prec[1:]):
+            return None
+        i = self._ids.get(succ[-1])
+        if i is None:
+            return None
+        lo, hi = self._indptr[row], self._indptr[row+1]
+        j = lo + int(np.searchsorted(self._indices[lo:hi], i))
+        if j < hi and self._indices[j] == i:
+            return float(self._probs[j])
+        return None
+
+    def log_likelihoods(self, token_lists, unseen=None):
+        '''Compute the log-likelihoods of many token sequences at once.
+
+        The log-likelihood of a sequence is the sum of the log-probabilities
+        of its state transitions. All sequences are interned and encoded to
+        (order+1)-gram codes together, and the transitions are looked up
+        for all of them at once with binary searches over the rows of the
+        matrix. Summing in log space keeps the scores of long sequences from
+        underflowing.
+
+        :param list token_lists: Sequences, each a list of tokens.
+        :param unseen:
+            Callable, which is given the number of unobserved transitions and
+            returns their probabilities as an array. If **None**, the
+            unobserved transitions have zero probability.
+        :returns:
+            NumPy array of log-likelihoods, one per sequence. Sequences
+            with no transitions get zero.
+        '''
+        o = self._order
+        n = len(token_lists)
+        ids = self._ids
+        lengths = np.array([len(t) for t in token_lists], dtype=np.int64)
+        flat = np.fromiter((ids.get(t, -1) for tokens in token_lists
+                            for t in tokens),
+                           dtype=np.int64, count=int(lengths.sum()))
+        text = np.repeat(np.arange(n), lengths)
+        starts = np.cumsum(lengths) - lengths
+        pos = np.arange(len(flat)) - starts[text]
+        valid = np.flatnonzero(pos < lengths[text] - o)
+
+        known = np.ones(len(valid), dtype=bool)
+        codes = np.zeros(len(valid), dtype=np.int64)
+        for j in range(o + 1):
+            token_ids = flat[valid + j]
+            known &= token_ids >= 0
+            codes = codes * self._base + token_ids
+
+        probs = np.zeros(len(valid))
+        found = np.zeros(len(valid), dtype=bool)
+        k = np.flatnonzero(known)
+        j = self._lookup(codes[k] // self._base, codes[k] % self._base)
+        found[k] = j >= 0
+        probs[found] = self._probs[j[j >= 0]]
+        missing = ~found
+        if unseen is not None and missing.any():
+            probs[missing] = unseen(int(missing.sum()))
+        with np.errstate(divide='ignore'):
+            logp = np.log(probs)
+        return np.bincount(text[valid], weights=logp, minlength=n)
+
+    def _lookup(self, state_codes, token_ids):
+        '''Find the entries of many transitions in the matrix.
+
+        The rows are searched in lockstep, halving the remaining slice of
+        each row on every step, so only the arrays of the matrix are read
+        and nothing of their size is built.
+
+        :param state_codes: Codes of the preceding states.
+        :param token_ids: Ids of the successor tokens.
+        :returns:
+            NumPy array of the entries' positions, -1 for the transitions
+            which are not in the matrix.
+        '''
+        keys = self._keys
+        if len(keys) == 0:
+            return np.full(len(state_codes), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(keys, state_codes), len(keys) - 1)
+        in_rows = keys[rows] == state_codes
+        lo = np.where(in_rows, self._indptr[rows], 0)
+        hi = np.where(in_rows, self._indptr[rows + 1], 0)
+        last = len(self._indices) - 1
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            right = self._indices[np.minimum(mid, last)] < token_ids
+            lo = np.where(active & right, mid + 1, lo)
+            hi = np.where(active & ~right, mid, hi)
+        end = np.where(in_rows, self._indptr[rows + 1], 0)
+        found = (lo < end) & (self._indices[np.minimum(lo, last)] ==
+                              token_ids)
+        return np.where(found, lo, -1)
+
+    def generate_batch(self, n, length=10):
+        '''Generate **n** texts by advancing all chains in lockstep.
+
+        On each step the successors of all the live chains are drawn at once
+        with a vectorized binary search over the cumulative counts. Token
+        ids are collected into an array and turned into text only at the end.
+        A chain stops, as in :meth:`~markov_agent.MarkovAgent.generate`,
+        when it reaches a state with no successors.
+
+        The random numbers are drawn from a NumPy generator seeded from
+        :mod:`random`, so :func:`random.seed` makes the output reproducible.
+
+        :param int n: Number of texts to generate.
+        :param int length: Maximum length of each text in tokens.
+        :returns: list of generated texts (tokens joined with spaces).
+        '''
+        o = self._order
+        base = self._base
+        rng = np.random.default_rng(random.getrandbits(64))
+        if self._starts is not None:
+            rows = self._start_rows[self._starts.sample_many(n, rng)]
+        else:
+            rows = rng.integers(len(self._keys), size=n)
+        codes = self._keys[rows]
+        length = max(length, o)
+        out = np.full((n, length), -1, dtype=np.int64)
+        code = codes.copy()
+        for j in range(o - 1, -1, -1):
+            out[:, j] = code % base
+            code //= base
+
+        # Chains which are still in a state with successors.
+        live = np.arange(n)
+        shift = base ** (o - 1)
+        for pos in range(o, length):
+            if len(live) == 0:
+                break
+            lo = self._indptr[rows]
+            hi = self._indptr[rows + 1]
+            offset = np.where(lo > 0, self._cum[lo - 1], 0.0)
+            target = offset + rng.random(len(live)) * self._totals[rows]
+            j = np.minimum(np.searchsorted(self._cum, target, side='right'),
+                           hi - 1)
+            tokens = self._indices[j]
+            out[live, pos] = tokens
+            codes = (codes % shift) * base + tokens
+            rows = np.minimum(np.searchsorted(self._keys, codes),
+                              len(self._keys) - 1)
+            alive = self._keys[rows] == codes
+            live, rows, codes = live[alive], rows[alive], codes[alive]
+
+        vocab = self._vocab
+        return [' '.join(vocab[i] for i in chain if i >= 0)
+                for chain in out.tolist()]
+
+    def sample(self, state):
+        '''Draw a successor for the given state.
+
+        The successor is found with a binary search over the row's slice of
+        the cumulative counts.
+
+        :param state: A state of the MC (tuple of tokens)
+        :returns:
+            The successor state, or **None** if **state** has no successors.
+        '''
+        row = self._row(state)
+        if row < 0:
+            return None
+        lo, hi = int(self._indptr[row]), int(self._indptr[row+1])
+        base = self._cum[lo-1] if lo > 0 else 0.0
+        rnd = base + random.random() * self._totals[row]
+        j = min(bisect.bisect_right(self._cum, rnd, lo, hi), hi - 1)
+        return tuple(state[1:]) + (self._vocab[self._indices[j]],)
+
+
+class MarkovModel(Mapping):
+    '''Markov chain model which can be updated with new sentences.
+
+    The model keeps the state transition counts in the same nested
+    dictionaries as :func:`~markov_agent.get_transitions`, and
+    :meth:`update` adds the transitions of new sentences to them in place.
+    The probabilities (and the cumulative distributions used for sampling)
+    are computed lazily: a state is normalized when it is first looked up
+    after its counts have changed, so an update costs time only for the
+    states it touches.
+    '''
+    def __init__(self, order, tokenized_sentences=None):
+        '''
+        :param int order: The order of the Markov chain.
+        :param tokenized_sentences:
+            Optional iterable of sentences (lists of tokens) to start with.
+        '''
+        self._order = order
+        self._transitions = {}
+        # Normalized states: prec -> (probabilities, successors, cdf)
+        self._normalized = {}
+        self._states = []
+        self._starts = StartStates()
+        if tokenized_sentences is not None:
+            self.update(tokenized_sentences)
+
+    @property
+    def order(self):
+        '''The order of the Markov chain, i.e. the length of its states.
+        '''
+        return self._order
+
+    @property
+    def transitions(self):
+        '''The state transition counts as nested dictionaries.
+        '''
+        return self._transitions
+
+    @property
+    def starts(self):
+        '''The counts of the sentence-initial states.
+        '''
+        return self._starts.counts
+
+    def update(self, tokenized_sentences):
+        '''Count the state transitions of new sentences into the model.
+
+        :param tokenized_sentences:
+            Iterable of sentences, each sentence a list of tokens. Can be a
+            generator, the sentences are consumed one at a time.
+        '''
+        o = self._order
+        transitions = self._transitions
+        for sentence in tokenized_sentences:
+            if len(sentence) > o:
+                self._starts.add(tuple(sentence[:o]))
+            for i in range(len(sentence)-o):
+                pred = tuple(sentence[i:i+o])
+                succ = tuple(sentence[i+1:i+1+o])
+                succ_counts = transitions.get(pred)
+                if succ_counts is None:
+                    succ_counts = transitions[pred] = {}
+                    self._states.append(pred)
+                succ_counts[succ] = succ_counts.get(succ, 0.0) + 1.0
+                # Normalize the state again when it is next needed.
+                self._normalized.pop(pred, None)
+
+    def _normalize(self, prec):
+        '''Return (probabilities, successors, cdf) of the state, or **None**
+        if it has no successors.
+        '''
+        normalized = self._normalized.get(prec)
+        if normalized is None:
+            succ_counts = self._transitions.get(prec)
+            if succ_counts is None:
+                return None
+            total = sum(succ_counts.values())
+            probs = {succ: count / total for succ, count in
+                     succ_counts.items()}
+            succs = list(succ_counts.keys())
+            cdf = list(itertools.accumulate(succ_counts.values()))
+            normalized = (probs, succs, cdf)
+            self._normalized[prec] = normalized
+        return normalized
+
+    def __len__(self):
+        return len(self._transitions)
+
+    def __iter__(self):
+        return iter(self._transitions)
+
+    def __contains__(self, state):
+        return state in self._transitions
+
+    def __getitem__(self, state):
+        normalized = self._normalize(state)
+        if normalized is None:
+            raise KeyError(state)
+        return normalized[0]
+
+    def random_state(self):
+        '''Return a random starting state, drawn in proportion to how often
+        the state begins a sentence.
+        '''
+        if len(self._starts) > 0:
+            return self._starts.sample()
+        return random.choice(self._states)
+
+    def successors(self, state):
+        '''Return the successors of the state as a list of
+        (successor, probability)-tuples. The list is empty if the state has
+        no successors.
+        '''
+        normalized = self._normalize(state)
+        if normalized is None:
+            return []
+        return list(normalized[0].items())
+
+    def probability(self, prec, succ):
+        '''Return the probability of the state transition from **prec** to
+        **succ**, or **None** if the transition has not been observed.
+        '''
+        normalized = self._normalize(prec)
+        if normalized is None:
+            return None
+        return normalized[0].get(succ)
+
+    def sample(self, state):
+        '''Draw a successor for the given state.
+
+        :param state: A state of the MC (tuple of tokens)
+        :returns:
+            The successor state, or **None** if **state** has no successors.
+        '''
+        normalized = self._normalize(state)
+        if normalized is None:
+            return None
+        _, succs, cdf = normalized
+        rnd = random.random() * cdf[-1]
+        return succs[min(bisect.bisect_right(cdf, rnd), len(succs) - 1)]
+
+
+class _TrieNode():
+    '''Node of :class:`NGramTrie`.
+
+    ``count`` is the count of the n-gram ending at the node and ``total`` the
+    sum of its children's counts, i.e. how many times the n-gram was followed
+    by some token. ``cdf`` caches the children and their cumulative counts
+    for sampling until the children change.
+    '''
+    __slots__ = ('count', 'total', 'children', 'cdf')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.children = {}
+        self.cdf = None
+
+
+class NGramTrie():
+    '''Variable order Markov chain model with interpolated backoff.
+
+    The counts of all n-grams up to length ``order+1`` are stored in a single
+    trie, where n-grams with a common prefix share the nodes of the prefix.
+    The probability of a token following a state is interpolated over all
+    the suffixes of the state with Witten-Bell smoothing:
+
+    .. math::
+        P(w|h) = \\frac{c(h, w) + T(h) P(w|h')}{c(h) + T(h)},
+
+    where :math:`h'` is :math:`h` without its first token, :math:`c(h)` is
+    how many times :math:`h` has been followed by any token and :math:`T(h)`
+    is the number of distinct tokens that have followed it. The recursion
+    ends in a uniform distribution over the vocabulary. Unseen transitions
+    thus get a probability from the shorter contexts instead of a random
+    value, and generation backs off to shorter contexts instead of stopping
+    in states which have no successors.
+    '''
+    def __init__(self, order, tokenized_sentences=None):
+        '''
+        :param int order:
+            The order of the Markov chain, i.e. the length of the longest
+            context. The trie stores n-grams up to length ``order+1``.
+        :param tokenized_sentences:
+            Optional iterable of sentences (lists of tokens) to start with.
+        '''
+        self._order = order
+        self._root = _TrieNode()
+        self._states = []
+        self._starts = StartStates()
+        if tokenized_sentences is not None:
+            self.update(tokenized_sentences)
+
+    @property
+    def order(self):
+        '''The order of the Markov chain, i.e. the length of its states.
+        '''
+        return self._order
+
+    def update(self, tokenized_sentences):
+        '''Count the n-grams of new sentences into the trie.
+
+        :param tokenized_sentences:
+            Iterable of sentences, each sentence a list of tokens.
+        '''
+        n = self._order + 1
+        for sentence in tokenized_sentences:
+            if len(sentence) > self._order:
+                self._starts.add(tuple(sentence[:self._order]))
+            for i in range(len(sentence)):
+                # Walk down the path of the n-grams starting at i, counting
+                # all of them (lengths 1..n) on the way.
+                node = self._root
+                for depth, token in enumerate(sentence[i:i+n]):
+                    child = node.children.get(token)
+                    if child is None:
+                        child = node.children[token] = _TrieNode()
+                    if node.total == 0 and depth == self._order:
+                        self._states.append(tuple(sentence[i:i+depth]))
+                    child.count += 1
+                    node.total += 1
+                    node.cdf = None
+                    node = child
+
+    def _find(self, tokens):
+        '''Return the node of the n-gram, or **None** if it is not in the trie.
+        '''
+        node = self._root
+        for token in tokens:
+            node = node.children.get(token)
+            if node is None:
+                return None
+        return node
+
+    def _contexts(self, state):
+        '''Return the nodes of the state's suffixes from the shortest (the
+        root) to the longest, leaving out the ones never followed by a token.
+        '''
+        nodes = []
+        for k in range(len(state), -1, -1):
+            node = self._find(state[k:])
+            if node is None:
+                # Longer suffixes cannot be in the trie either.
+                break
+            if node.total > 0:
+                nodes.append(node)
+        return nodes
+
+    def __contains__(self, state):
+        if len(state) != self._order:
+            return False
+        node = self._find(state)
+        return node is not None and node.total > 0
+
+    def random_state(self):
+        '''Return a random starting state, drawn in proportion to how often
+        the state begins a sentence.
+        '''
+        if len(self._starts) > 0:
+            return self._starts.sample()
+        return random.choice(self._states)
+
+    def token_probability(self, state, token):
+        '''Return the interpolated probability of **token** following
+        **state**.
+        '''
+        vocabulary_size = max(len(self._root.children), 1)
+        prob = 1.0 / vocabulary_size
+        for node in self._contexts(state):
+            child = node.children.get(token)
+            count = child.count if child is not None else 0
+            types = len(node.children)
+            prob = (count + types * prob) / (node.total + types)
+        return prob
+
+    def successors(self, state):
+        '''Return the successors observed after the longest known suffix of
+        the state as a list of (successor, probability)-tuples, with their
+        interpolated probabilities.
+
+        The interpolated distribution gives some probability to every token
+        in the vocabulary, but only the observed successors are listed.
+        '''
+        contexts = self._contexts(state)
+        if len(contexts) == 0:
+            return []
+        prefix = tuple(state[1:])
+        return [(prefix + (token,), self.token_probability(state, token))
+                for token in contexts[-1].children]
+
+    def probability(self, prec, succ):
+        '''Return the interpolated probability of the state transition from
+        **prec** to **succ**, or **None** if **succ** is not **prec** shifted
+        by one token.
+        '''
+        if tuple(succ[:-1]) != tuple(prec[1:]):
+            return None
+        return self.token_probability(prec, succ[-1])
+
+    def sample(self, state):
+        '''Draw a successor for the given state.
+
+        Starting from the longest context, the successor's last token is
+        drawn from the context's own counts with probability
+        :math:`c(h) / (c(h) + T(h))`, otherwise the draw backs off to the next
+        shorter context. This samples exactly the interpolated distribution of
+        :meth:`token_probability`.
+
+        :param state: A state of the MC (tuple of tokens)
+        :returns:
+            The successor state, or **None** if the trie is empty.
+        '''
+        if len(self._root.children) == 0:
+            return None
+        token = None
+        for node in reversed(self._contexts(state)):
+            types = len(node.children)
+            if random.random() * (node.total + types) < node.total:
+                token = self._sample_child(node)
+                break
+        if token is None:
+            token = random.choice(list(self._root.children))
+        return tuple(state[1:]) + (token,)
+
+    def _sample_child(self, node):
+        '''Draw a child token of the node in proportion to its count.
+        '''
+        if node.cdf is None:
+            tokens = list(node.children)
+            cdf = list(itertools.accumulate(
+                child.count for child in node.children.values()))
+            node.cdf = (tokens, cdf)
+        tokens, cdf = node.cdf
+        i = bisect.bisect_right(cdf, random.random() * cdf[-1])
+        return tokens[min(i, len(tokens) - 1)]
+
+
+class CountMinSketch():
+    '''Count-min sketch for approximate counting in bounded memory.
+
+    The sketch is a table of **depth** rows of **width** counters. A key is
+    counted by incrementing one counter on each row, chosen by hashing the
+    key, and its count is estimated as the minimum of its counters. The
+    estimate is never below the true count, and with probability at least
+    1 - **delta** it exceeds it by at most :attr:`error_bound`, i.e.
+    ``e / width`` times the total count of all keys.
+
+    The keys are hashed with :func:`hashlib.md5` (truncated to 64 bits)
+    over their :func:`repr`, so the sketches of different processes can be
+    merged.
+    '''
+    def __init__(self, memory=2**26, delta=0.01):
+        '''
+        :param int memory: Memory budget for the counters in bytes.
+        :param float delta:
+            Probability that an estimate exceeds the error bound. Sets the
+            depth of the sketch to ``ceil(ln(1 / delta))``.
+        '''
+        self.depth = max(1, math.ceil(math.log(1.0 / delta)))
+        self.width = memory // (4 * self.depth)
+        if self.width < 1:
+            raise ValueError("Memory budget of {} bytes is too small."
+                             .format(memory))
+        self.delta = delta
+        self.total = 0
+        self._table = np.zeros((self.depth, self.width), dtype=np.uint32)
+        self._rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+
+    @property
+    def epsilon(self):
+        '''Relative error of the estimates, ``e / width``.
+        '''
+        return math.e / self.width
+
+    @property
+    def error_bound(self):
+        '''Maximum overestimate of a count with probability 1 - delta.
+        '''
+        return self.epsilon * self.total
+
+    def _columns(self, keys):
+        '''Return the counters of the keys as a (depth, len(keys)) array.
+
+        The d hash functions are derived from the two halves of a single
+        64-bit hash as ``h1 + i * h2`` (Kirsch and Mitzenmacher).
+        '''
+        hashes = np.fromiter((_stable_hash(key) for key in keys),
+                             dtype=np.uint64, count=len(keys))
+        h1 = hashes & np.uint64(0xffffffff)
+        h2 = hashes >> np.uint64(32)
+        return (h1 + self._rows * h2) % np.uint64(self.width)
+
+    def update(self, keys):
+        '''Count each key in **keys** once.
+
+        :param keys: Iterable of hashable keys, e.g. n-gram tuples.
+        '''
+        for chunk in _chunks(keys, 65536):
+            self._add(chunk)
+
+    def _add(self, keys):
+        columns = self._columns(keys)
+        for i in range(self.depth):
+            np.add.at(self._table[i], columns[i], 1)
+        self.total += len(keys)
+        return columns
+
+    def _estimate(self, columns):
+        return self._table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def estimates(self, keys):
+        '''Estimate the counts of the keys.
+
+        :param list keys: Keys to estimate.
+        :returns: list of int.
+        '''
+        keys = list(keys)
+        if not keys:
+            return []
+        return self._estimate(self._columns(keys)).tolist()
+
+    def __getitem__(self, key):
+        return self.estimates([key])[0]
+
+    def merge(self, other):
+        '''Add the counts of another sketch with the same dimensions.
+        '''
+        if self._table.shape != other._table.shape:
+            raise ValueError("Cannot merge sketches of different dimensions.")
+        self._table += other._table
+        self.total += other.total
+
+
+class HeavyHitters():
+    '''The **k** most frequent keys of a stream, counted approximately with a
+    :class:`CountMinSketch`.
+
+    Besides the sketch, a candidate set of at most **k** keys with the
+    largest estimated counts is kept. When a key's estimate rises above the
+    smallest candidate's, it replaces that candidate.
+    '''
+    def __init__(self, k, memory=2**26, delta=0.01):
+        '''
+        :param int k: Number of keys to keep.
+        :param int memory: Memory budget of the sketch in bytes.
+        :param float delta: Failure probability of the sketch.
+        '''
+        self.k = k
+        self.sketch = CountMinSketch(memory=memory, delta=delta)
+        self._candidates = {}
+        # Min-heap of (estimate, key), possibly with stale estimates. It is
+        # rebuilt from the candidates when it grows past 2 * k entries.
+        self._heap = []
+
+    def update(self, keys):
+        '''Count each key in **keys** once.
+        '''
+        for chunk in _chunks(keys, 65536):
+            columns = self.sketch._add(chunk)
+            estimates = self.sketch._estimate(columns).tolist()
+            # The later estimates of a repeated key are the same or larger.
+            for key, estimate in dict(zip(chunk, estimates)).items():
+                self._offer(key, estimate)
+
+    def _offer(self, key, estimate):
+        candidates = self._candidates
+        if key in candidates or len(candidates) < self.k:
+            candidates[key] = estimate
+            heapq.heappush(self._heap, (estimate, key))
+            if len(self._heap) > 2 * self.k:
+                # Drop the stale entries, so that the heap stays O(k).
+                self._heap = [(e, c) for c, e in candidates.items()]
+                heapq.heapify(self._heap)
+            return
+        heap = self._heap
+        while heap:
+            smallest, old = heap[0]
+            if candidates.get(old) == smallest:
+                break
+            heapq.heappop(heap)
+            if old in candidates:
+                heapq.heappush(heap, (candidates[old], old))
+        if estimate > heap[0][0]:
+            _, old = heapq.heapreplace(heap, (estimate, key))
+            del candidates[old]
+            candidates[key] = estimate
+
+    def most_common(self, n=None):
+        '''Return the candidates with their estimated counts, most frequent
+        first.
+
+        :param int n: Number of keys to return, all **k** if None.
+        :returns: list of (key, estimate)-tuples.
+        '''
+        ranked = sorted(self._candidates.items(), key=lambda x: -x[1])
+        return ranked if n is None else ranked[:n]
+
+
+def ngram_transitions(ngram_counts):
+    '''Convert (order+1)-gram counts to state transition counts.
+
+    :param ngram_counts:
+        Iterable of (ngram, count)-tuples, or a dict mapping the n-grams to
+        their counts.
+    :returns:
+        Nested dictionaries of state transition counts, in the same format as
+        :func:`~markov_agent.get_transitions`.
+    '''
+    if isinstance(ngram_counts, Mapping):
+        ngram_counts = ngram_counts.items()
+    transitions = {}
+    for ngram, count in ngram_counts:
+        succ_counts = transitions.setdefault(tuple(ngram[:-1]), {})
+        succ = tuple(ngram[1:])
+        succ_counts[succ] = succ_counts.get(succ, 0.0) + float(count)
+    return transitions
+
+
+def _stable_hash(key):
+    digest = hashlib.md5(repr(key).encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _MappedVocabulary(Sequence):
+    '''Read-only token list which decodes the tokens from a memory-mapped
+    file on access.
+    '''
+    def __init__(self, buf, start, offsets):
+        self._buf = buf
+        self._start = start
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        lo = self._start + int(self._offsets[i])
+        hi = self._start + int(self._offsets[i+1])
+        return self._buf[lo:hi].decode('utf8')
+
+
+def _aligned(offset):
+    return offset + (-offset % _ALIGNMENT)
+
+
+def _write_aligned(f, data):
+    f.write(data)
+    f.write(b'\0' * (-len(data) % _ALIGNMENT))
+
+
+def _check_base(vocabulary_size, order):
+    '''Check that the (order+1)-gram codes fit into 64-bit integers.
+    '''
+    base = max(vocabulary_size, 1)
+    if base ** (order + 1) >= 2 ** 63:
+        raise ValueError("Vocabulary of {} tokens is too large for order {}."
+                         .format(vocabulary_size, order))
+    return base
@@ -12,7 +12,8 @@ example.
 from creamas.core import CreativeAgent, Environment, Simulation, Artifact
 
 
-from collections import Counter
+from collections import Counter, deque
+import itertools
 import logging
 import random
 import re
@@ -20,6 +21,8 @@ import random
 
 import aiomas
 
+from edit_distance import SimilarityIndex, WordBatch
+
 # Logging setup. This is simplified setup as all agents use the same logger.
 # It _will_ cause some problems in asynchronous settings, especially if you
 # are logging to a file.
@@ -30,13 +33,30 @@ logger.setLevel(logging.DEBUG)
 
 class ListMemory():
     '''Simple list memory which stores all seen artifacts as is into a list.
+
+    The memory can be given an index of the artifacts' words, e.g.
+    :class:`~minhash.MinHashIndex`, which is updated whenever an artifact is
+    memorized or forgotten. :meth:`candidates` then shortlists only the
+    artifacts which are likely to be similar to a given word, so that large
+    memories can be searched at a roughly constant cost.
     '''
-    def __init__(self, capacity):
+    def __init__(self, capacity, index=None, recent=20):
         '''
         :param int capacity: The maximum number of artifacts in the memory.
+        :param index:
+            Optional index with ``add(key, word)``, ``remove(key)`` and
+            ``candidates(word)`` methods.
+        :param int recent:
+            Number of the newest artifacts which are always included in the
+            candidates when the memory has an index.
         '''
         self._capacity = capacity
-        self._artifacts = []
+        self._artifacts = deque()
+        # Artifact -> number of artifacts memorized before it.
+        self._order = {}
+        self._memorized = 0
+        self.index = index
+        self.recent = recent
 
     @property
     def capacity(self):
@@ -46,7 +66,7 @@ class ListMemory():
 
     @property
     def artifacts(self):
-        '''The artifacts currently in the memory.
+        '''The artifacts currently in the memory, the newest first.
         '''
         return self._artifacts
 
@@ -59,35 +79,35 @@ class ListMemory():
         :param artifact: Artifact to be learned.
         :type artifact: :class:`~creamas.core.artifact.Artifact`
         '''
-        if artifact in self._artifacts:
+        if artifact in self._order:
             return
 
-        self._artifacts.insert(0, artifact)
+        self._artifacts.appendleft(artifact)
+        self._order[artifact] = self._memorized
+        self._memorized += 1
+        if self.index is not None:
+            self.index.add(artifact, artifact.obj)
         if len(self._artifacts) > self.capacity:
-            self._artifacts = self._artifacts[:self.capacity]
+            forgotten = self._artifacts.pop()
+            del self._order[forgotten]
+            if self.index is not None:
+                self.index.remove(forgotten)
 
+    def candidates(self, word):
+        '''Return the artifacts which should be compared to **word**.
 
-def levenshtein(s, t):
-        '''Compute the edit distance between two strings.
+        Without an index, these are all the artifacts in the memory. With an
+        index, these are the artifacts shortlisted by the index and the
+        **recent** newest artifacts.
 
-        From Wikipedia article; Iterative with two matrix rows.
+        :param str word: The word to compare.
+        :returns: list of artifacts, the newest first.
         '''
-        if s == t: return 0
-        elif len(s) == 0: return len(t)
-        elif len(t) == 0: return len(s)
-        v0 = [None] * (len(t) + 1)
-        v1 = [None] * (len(t) + 1)
-        for i in range(len(v0)):
-            v0[i] = i
-        for i in range(len(s)):
-            v1[0] = i + 1
-            for j in range(len(t)):
-                cost = 0 if s[i] == t[j] else 1
-                v1[j + 1] = min(v1[j] + 1, v0[j + 1] + 1, v0[j] + cost)
-            for j in range(len(v0)):
-                v0[j] = v1[j]
-
-        return v1[len(t)]
+        if self.index is None:
+            return list(self._artifacts)
+        shortlist = set(itertools.islice(self._artifacts, self.recent))
+        shortlist.update(self.index.candidates(word))
+        return sorted(shortlist, key=lambda a: -self._order[a])
 
 
 def parse_words(filename, encoding, word_pattern, wlen_limits):
@@ -149,7 +169,8 @@ class ToyAgent(CreativeAgent):
     '''
 
     def __init__(self, env, filename, encoding='utf8', n=20,
-                 wlen_limits=(2,11), chars='abcdefghijklmnopqrstuvwxyz'):
+                 wlen_limits=(2,11), chars='abcdefghijklmnopqrstuvwxyz',
+                 memory=None):
         '''
         :param env:
             subclass of :py:class:`~creamas.core.environment.Environment`
@@ -164,6 +185,11 @@ class ToyAgent(CreativeAgent):
             (int, int)-tuple, acceptable word length limits
 
         :param str chars: acceptable characters in the words
+
+        :param memory:
+            The agent's memory, by default a :class:`ListMemory` of 20
+            artifacts. For large memories, give the memory an index, e.g.
+            ``ListMemory(100000, index=MinHashIndex())``.
         '''
         super().__init__(env)
         self.n = n
@@ -173,7 +199,10 @@ class ToyAgent(CreativeAgent):
         self.vocab = frequent_words(filename, encoding=encoding,
                                     word_pattern=self.word_pattern,
                                     wlen_limits=self.wlen_limits, n=20)
-        self.mem = ListMemory(20)
+        # The vocabulary is compared to every evaluated word, so it is
+        # indexed for finding the best match fast.
+        self._vocab_index = SimilarityIndex(self.vocab)
+        self.mem = ListMemory(20) if memory is None else memory
 
     def evaluate(self, artifact):
         '''Evaluate given artifact with respect to the agent's vocabulary and
@@ -216,24 +245,18 @@ class ToyAgent(CreativeAgent):
             (evaluation, word)-tuple, containing both the evaluation and the
             word giving the maximum evaluation
         '''
-        evaluation = 0.0
-        evaluation_word = artifact.obj
-        matching_word = self.vocab[0]
-        for word in self.vocab:
-            lev = levenshtein(evaluation_word, word)
-            mlen = max(len(evaluation_word), float(len(word)))
-            current_evaluation = 1.0 - (float(lev) / mlen)
-            if current_evaluation > evaluation:
-                evaluation = current_evaluation
-                matching_word = word
-        return evaluation, matching_word
+        # The index returns the first word with the highest evaluation, as a
+        # loop over the vocabulary would.
+        return self._vocab_index.best_match(artifact.obj)
 
     def novelty(self, artifact):
         '''Compute the novelty of a given artifact with respect to the artifacts
         in the agent's memory.
 
         The novelty of an artifact is the minimum distance to any artifact in
-        the agent's memory.
+        the agent's memory. If the memory has an index, only the artifacts it
+        shortlists are compared, so the novelty is approximate: it may be too
+        high if the closest artifact is missed.
 
         Actual evaluation formula for a string :math:`s` is:
 
@@ -254,16 +277,17 @@ class ToyAgent(CreativeAgent):
             return 1.0, None
 
         novelty = 1.0
-        evaluation_word = artifact.obj
-        matching_word = self.mem.artifacts[0].obj
-        for memart in self.mem.artifacts:
-            word = memart.obj
-            lev = levenshtein(evaluation_word, word)
-            mlen = max(len(evaluation_word), float(len(word)))
-            current_novelty = float(lev) / mlen
-            if current_novelty < novelty:
-                novelty = current_novelty
-                matching_word = word
+        words = [memart.obj for memart in self.mem.candidates(artifact.obj)]
+        if len(words) == 0:
+            return 1.0, None
+        matching_word = words[0]
+        # Compare to all the candidates at once. The first word with the
+        # lowest novelty is the match.
+        novelties = WordBatch(words).normalized_distances(artifact.obj)
+        best = int(novelties.argmin())
+        if novelties[best] < novelty:
+            novelty = float(novelties[best])
+            matching_word = words[best]
         return novelty, matching_word
 
 
@@ -0,0 +1,165 @@
+'''
+.. py:module:: minhash
+    :platform: Unix
+
+Approximate similarity search for words with MinHash signatures and
+locality-sensitive hashing (LSH).
+
+A word is represented by the set of its q-grams (substrings of length q,
+with the word padded by ``^`` and ``$`` so that the first and last characters
+count too). Words with a small edit distance share most of their q-grams,
+i.e. the Jaccard similarity of their q-gram sets is high. The MinHash
+signature of a set consists of the minimum values of a number of random hash
+functions over the set. The probability that two sets have the same minimum
+for a hash function equals their Jaccard similarity.
+
+The signature is split into bands of a few rows each, and each band is
+hashed into a bucket. Words which are similar enough collide in at least one
+band with high probability, while dissimilar words rarely do. A query only
+looks at the words in its own buckets, and as the buckets have a maximum
+size, its cost stays bounded however many words are indexed.
+
+See A. Rajaraman and J. D. Ullman: Mining of Massive Datasets, chapter 3.
+'''
+from collections import Counter
+import random
+import zlib
+
+import numpy as np
+
+# Mersenne prime for the universal hash functions (a * x + b) mod p.
+_PRIME = (1 << 31) - 1
+
+
+class MinHashIndex():
+    '''Index of words for finding the words similar to a query.
+
+    Each word is indexed under a key (e.g. the artifact containing it) and
+    the keys can be added and removed one at a time, so the index can follow
+    a changing memory.
+
+    With short words and the default q-grams and bands, many unrelated words
+    share buckets, and unbounded buckets grow linearly with the number of
+    keys. Indexing 1k, 10k and 100k artificial words of 2-11 characters, the
+    largest bucket had about 80, 840 and 8300 keys and a query took 0.06,
+    0.21 and 0.98 ms. With the default **bucket_size** of 64, a query scans
+    at most 1024 keys and took 0.05, 0.16 and 0.36 ms (0.48 ms with 300k
+    keys), while the exact novelty was found for 93 % instead of 97 % of the
+    words one edit away from the memory.
+    '''
+    def __init__(self, q=2, bands=16, rows=2, max_candidates=100,
+                 bucket_size=64, seed=0):
+        '''
+        :param int q: Length of the q-grams.
+        :param int bands: Number of bands in the signature.
+        :param int rows:
+            Number of hash values in each band. More rows make the collisions
+            of dissimilar words rarer, more bands make the collisions of
+            similar words more likely.
+        :param int max_candidates:
+            Maximum number of candidates returned for a query. The candidates
+            sharing the most bands with the query are returned.
+        :param int bucket_size:
+            Maximum number of keys in a bucket. When a bucket is full, its
+            oldest key is dropped from it (but stays in its other buckets),
+            so a query never scans more than **bands** * **bucket_size**
+            keys. None for unbounded buckets.
+        :param int seed: Seed for drawing the hash functions.
+        '''
+        self.q = q
+        self.bands = bands
+        self.rows = rows
+        self.max_candidates = max_candidates
+        self.bucket_size = bucket_size
+        rng = random.Random(seed)
+        n = bands * rows
+        self._a = np.array([rng.randrange(1, _PRIME) for _ in range(n)],
+                           dtype=np.int64)[:, None]
+        self._b = np.array([rng.randrange(0, _PRIME) for _ in range(n)],
+                           dtype=np.int64)[:, None]
+        # (band, band hash) -> keys in the bucket. The buckets are dicts
+        # rather than sets, so that they are iterated in insertion order and
+        # ties between the candidates are broken the same way on every run.
+        self._buckets = {}
+        # key -> (band hashes, insertion number)
+        self._keys = {}
+        self._added = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def qgrams(self, word):
+        '''Return the set of q-grams of the padded word.
+        '''
+        padded = '^' + word + '$'
+        if len(padded) <= self.q:
+            return {padded}
+        return {padded[i:i+self.q] for i in range(len(padded) - self.q + 1)}
+
+    def signature(self, word):
+        '''Compute the MinHash signature of the word's q-grams.
+
+        :returns: :class:`numpy.ndarray` of **bands** * **rows** ints.
+        '''
+        # The built-in hash of a string changes from process to process, so
+        # a stable hash keeps the index reproducible with the same seed.
+        grams = np.array([zlib.crc32(g.encode('utf8')) % _PRIME
+                          for g in self.qgrams(word)], dtype=np.int64)
+        # a, b and the gram hashes are below 2**31, so the products fit.
+        return ((self._a * grams + self._b) % _PRIME).min(axis=1)
+
+    def _band_hashes(self, word):
+        sig = self.signature(word).reshape(self.bands, self.rows)
+        return [(i, zlib.crc32(band.tobytes())) for i, band in enumerate(sig)]
+
+    def add(self, key, word):
+        '''Index **word** under **key**, replacing the key's earlier word.
+        '''
+        if key in self._keys:
+            self.remove(key)
+        bands = self._band_hashes(word)
+        for band in bands:
+            bucket = self._buckets.setdefault(band, {})
+            bucket[key] = None
+            if self.bucket_size is not None and \
+                    len(bucket) > self.bucket_size:
+                del bucket[next(iter(bucket))]
+        self._keys[key] = (bands, self._added)
+        self._added += 1
+
+    def remove(self, key):
+        '''Remove the key from the index. Does nothing if it is not indexed.
+        '''
+        entry = self._keys.pop(key, None)
+        if entry is None:
+            return
+        for band in entry[0]:
+            bucket = self._buckets.get(band)
+            # The key may have been dropped from a full bucket already.
+            if bucket is None or key not in bucket:
+                continue
+            del bucket[key]
+            if not bucket:
+                del self._buckets[band]
+
+    def candidates(self, word):
+        '''Return the keys whose words are likely to be similar to **word**.
+
+        :returns:
+            list of at most **max_candidates** keys, the most recently added
+            first.
+        '''
+        collisions = Counter()
+        for band in self._band_hashes(word):
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                collisions.update(bucket.keys())
+        if len(collisions) > self.max_candidates:
+            keys = [key for key, _ in
+                    collisions.most_common(self.max_candidates)]
+        else:
+            keys = list(collisions)
+        return sorted(keys, key=lambda key: -self._keys[key][1])